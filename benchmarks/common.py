@@ -0,0 +1,76 @@
+import os
+import sys
+import json
+import glob
+import random
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures')
+
+# Worker modules are imported without the "app" package, it would configure celery on import
+sys.path.insert(0, os.path.join(ROOT, 'worker', 'app'))
+sys.path.insert(0, ROOT)
+
+
+def synthetic_lesson(day, hour, group_id, index):
+    # Lessons of different groups differ, otherwise they are stored as one lecture of a stream
+    return {
+        'subject': 'Дисциплина {0}-{1}'.format(group_id, index),
+        'subject_short': 'Дисц. {0}'.format(index),
+        'type': 0,
+        'additional_info': '',
+        'time_start': '{0:02d}:00'.format(hour),
+        'time_end': '{0:02d}:40'.format(hour + 1),
+        'parity': 0,
+        'typeObj': {'id': 2, 'name': 'Лекции', 'abbr': 'Лек'},
+        'groups': [{'id': group_id, 'name': '{0}/0000{1}'.format(group_id, index % 3), 'level': 3,
+                    'type': 'common', 'kind': 0, 'spec': '09.03.01 Информатика',
+                    'faculty': {'id': 95, 'name': 'Институт', 'abbr': 'ИКНТ'}}],
+        'teachers': [{'id': 1000 + index, 'full_name': 'Иванов Иван Иванович', 'first_name': 'Иванов',
+                      'middle_name': 'Иван', 'last_name': 'Иванович', 'grade': 'доцент', 'chair': ''}],
+        'auditories': [{'id': 500 + index, 'name': str(100 + index),
+                        'building': {'id': 10, 'name': 'Главный учебный корпус', 'abbr': 'ГУК',
+                                     'address': 'Политехническая, 29'}}],
+        'webinar_url': '',
+        'lms_url': '',
+    }
+
+
+def synthetic_week(group_id, monday, lessons_per_day=4):
+    days = []
+    for weekday in range(6):
+        date = monday + timedelta(days=weekday)
+        days.append({'weekday': weekday + 1, 'date': date.strftime('%Y-%m-%d'),
+                     'lessons': [synthetic_lesson(date, 8 + 2 * i, group_id, weekday * lessons_per_day + i)
+                                 for i in range(lessons_per_day)]})
+    return days
+
+
+def synthetic_page(group_id=26000, monday=None, lessons_per_day=4):
+    monday = monday or datetime(2018, 11, 12)
+    state = {
+        'faculties': {'data': [{'id': 95, 'name': 'Институт', 'abbr': 'ИКНТ'}]},
+        'lessons': {'week': {'date_start': monday.strftime('%Y.%m.%d'),
+                             'date_end': (monday + timedelta(days=6)).strftime('%Y.%m.%d'), 'is_odd': True},
+                    'data': {str(group_id): synthetic_week(group_id, monday, lessons_per_day)}},
+    }
+    # Roughly the layout of ruz.spbstu.ru: markup rendered on server, state in the first body script
+    markup = ''.join('<div class="lesson"><span>{0}</span></div>'.format(i) for i in range(400))
+    return ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>Расписание</title>'
+            '<link rel="stylesheet" href="/static/main.css"></head><body>'
+            '<script>\n    window.__INITIAL_STATE__ = {0};\n</script>'
+            '<div id="root">{1}</div><script src="/static/main.js"></script></body></html>'
+            ).format(json.dumps(state, ensure_ascii=False), markup).encode('utf-8')
+
+
+def sample_pages(paths=None):
+    paths = paths or sorted(glob.glob(os.path.join(FIXTURES, '**', '*.html'), recursive=True))
+    if not paths:
+        random.seed(0)
+        return [('synthetic-{0}'.format(i), synthetic_page(26000 + i)) for i in range(5)]
+    pages = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            pages.append((os.path.relpath(path, ROOT), f.read()))
+    return pages
@@ -0,0 +1,87 @@
+"""
+Compares lesson fingerprinting: gen_checkstring + sha256, used before, against canonical JSON bytes + blake2b.
+
+    python benchmarks/fingerprint.py [lessons_per_batch ...]
+
+Batches are built from synthetic weeks. Besides timing it reports values, which the previous checksum didn't see.
+"""
+import sys
+import timeit
+import hashlib
+import collections
+from datetime import datetime, timedelta
+
+from common import synthetic_week
+
+from shared.model import fingerprint_lessons, lesson_fingerprint
+
+REPEAT = 20
+BATCHES = [24, 240, 2400]
+
+
+def gen_checkstring(dict_):
+    # Previous implementation, kept here for comparison only
+    dict_ = collections.OrderedDict(sorted(dict_.items()))
+    checkstr = ''
+    for v in dict_.values():
+        if isinstance(v, (list, tuple)):
+            for subv in v:
+                if isinstance(subv, dict):
+                    checkstr += gen_checkstring(subv)
+        elif isinstance(v, dict):
+            checkstr += gen_checkstring(v)
+        elif isinstance(v, int):
+            checkstr += str(v)
+        elif isinstance(v, datetime):
+            checkstr += v.strftime('%Y%m%d%H%M%S')
+        elif isinstance(v, str):
+            checkstr += v
+    return checkstr
+
+
+def legacy_fingerprint_lessons(lessons):
+    return [(hashlib.sha256(gen_checkstring({k: v for k, v in lesson.items() if k != 'groups'}).encode('utf-8'))
+             .hexdigest(),
+             hashlib.sha256(gen_checkstring(lesson).encode('utf-8')).hexdigest()) for lesson in lessons]
+
+
+def synthetic_lessons(count):
+    lessons = []
+    monday = datetime(2018, 11, 12)
+    while len(lessons) < count:
+        for day in synthetic_week(26000 + len(lessons), monday):
+            date = datetime.strptime(day['date'], '%Y-%m-%d')
+            for lesson in day['lessons']:
+                lesson = dict(lesson, weekday=day['weekday'],
+                              time_start=date + timedelta(hours=int(lesson['time_start'][:2])),
+                              time_end=date + timedelta(hours=int(lesson['time_end'][:2]), minutes=40))
+                lessons.append(lesson)
+        monday += timedelta(days=7)
+    return lessons[:count]
+
+
+def blind_spots():
+    lesson = synthetic_lessons(1)[0]
+    changes = {'bool': dict(lesson, online=True), 'float': dict(lesson, hours=1.5), 'none': dict(lesson, lms_url=None),
+               'boundary': dict(lesson, subject=lesson['subject'][:-1], subject_short=lesson['subject'][-1:]
+                                + lesson['subject_short'])}
+    base_legacy, base = legacy_fingerprint_lessons([lesson])[0][1], lesson_fingerprint(lesson)[1]
+    for name, changed in sorted(changes.items()):
+        print('{0:<10} previous: {1:<10} current: {2}'.format(
+            name, 'changed' if legacy_fingerprint_lessons([changed])[0][1] != base_legacy else 'MISSED',
+            'changed' if lesson_fingerprint(changed)[1] != base else 'MISSED'))
+
+
+def main(sizes):
+    print('{0:>8} {1:>14} {2:>14} {3:>8}'.format('lessons', 'previous, ms', 'current, ms', 'speedup'))
+    for size in sizes:
+        lessons = synthetic_lessons(size)
+        slow = timeit.timeit(lambda: legacy_fingerprint_lessons(lessons), number=REPEAT) / REPEAT * 1000
+        fast = timeit.timeit(lambda: fingerprint_lessons(lessons), number=REPEAT) / REPEAT * 1000
+        print('{0:>8} {1:>14.3f} {2:>14.3f} {3:>7.1f}x'.format(size, slow, fast, slow / fast))
+    print()
+    blind_spots()
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or BATCHES)
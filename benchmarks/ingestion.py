@@ -0,0 +1,232 @@
+"""
+Offline benchmark of the worker ingestion pipeline: week pages are fetched and parsed by collect_weeks_pages
+and reconciled by sync_weeks, the same functions are called by process_sub.
+
+    python benchmarks/ingestion.py [--subs 1 100 10000] [--weeks 5] [--mongo mongodb://localhost:27017]
+                                   [--output benchmarks/results/ingestion.json]
+    python benchmarks/ingestion.py --record FACULTY_ID:GROUP_ID [...]
+
+Pages are replayed from benchmarks/fixtures/faculty/<faculty>/groups/<group>/<week>.html, groups without saved
+pages get synthetic ones. Committed pages of groups 26000-26002 are samples in ruz.spbstu.ru layout with lectures
+shared by the stream, real pages are saved there with --record. Every size runs twice: "initial" fills an empty database,
+"refresh" repeats it over stored lessons and week states, when every week is skipped by fingerprint.
+
+Database given by --mongo/--db is dropped. Results are written as sorted JSON without timestamps,
+so the result file of two commits can be compared with diff. Peak memory is measured by separate run
+under tracemalloc, timings aren't affected by it.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import collections
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+
+import requests
+from requests.adapters import BaseAdapter
+from pymongo import MongoClient, monitoring
+
+from common import ROOT, FIXTURES, synthetic_page
+
+import collection
+from collection import collect_weeks_pages, get_session
+from shared.model import Studiesdata
+from shared.ingest import sync_weeks
+from shared.indexes import ensure_indexes
+from shared.timeworks import week_monday
+
+SIZES = [1, 100, 10000]
+WEEKS = 5
+# The same as WEEKS_CONCURRENCY of the worker
+CONCURRENCY = 4
+FACULTY = 95
+FIRST_GROUP = 26000
+FIRST_WEEK = datetime(2018, 11, 12)
+OUTPUT = os.path.join(ROOT, 'benchmarks', 'results', 'ingestion.json')
+
+
+def fixture_path(faculty_id, group_id, week):
+    return os.path.join(FIXTURES, 'faculty', str(faculty_id), 'groups', str(group_id), '{0}.html'.format(week))
+
+
+class ReplayAdapter(BaseAdapter):
+    # Answers requests to ruz.spbstu.ru with recorded pages, so network isn't a part of measurements
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        parts = url.path.strip('/').split('/')
+        week = parse_qs(url.query).get('date', [FIRST_WEEK.strftime('%Y-%m-%d')])[0]
+        response = requests.Response()
+        response.request, response.url = request, request.url
+        if len(parts) != 4 or parts[0] != 'faculty' or parts[2] != 'groups':
+            response.status_code = 404
+            response._content = b''
+            return response
+        path = fixture_path(parts[1], parts[3], week)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                response._content = f.read()
+        else:
+            response._content = synthetic_page(int(parts[3]), datetime.strptime(week, '%Y-%m-%d'))
+        response.status_code = 200
+        response.encoding = 'utf-8'
+        return response
+
+    def close(self):
+        pass
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.commands = collections.Counter()
+
+    def started(self, event):
+        self.commands[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def snapshot(self):
+        return dict(self.commands)
+
+
+def record(targets, weeks):
+    # Saves real pages for given FACULTY:GROUP pairs, weeks are the same as used for replay
+    for target in targets:
+        faculty_id, group_id = target.split(':')
+        for week in weeks:
+            week = week.strftime('%Y-%m-%d')
+            response = requests.get('http://ruz.spbstu.ru/faculty/{0}/groups/{1}'.format(faculty_id, group_id),
+                                    params={'date': week}, timeout=collection.TIMEOUT)
+            response.raise_for_status()
+            path = fixture_path(faculty_id, group_id, week)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(response.content)
+            print('Recorded {0}'.format(os.path.relpath(path, ROOT)))
+
+
+def recorded_groups():
+    root = os.path.join(FIXTURES, 'faculty')
+    if not os.path.isdir(root):
+        return []
+    return sorted((int(faculty), int(group)) for faculty in os.listdir(root)
+                  for group in os.listdir(os.path.join(root, faculty, 'groups')))
+
+
+def subscriptions(size):
+    recorded = recorded_groups()
+    subs = [{'_id': 'sub{0}'.format(index), 'facultie': faculty, 'id': group}
+            for index, (faculty, group) in enumerate(recorded[:size])]
+    for index in range(len(subs), size):
+        subs.append({'_id': 'sub{0}'.format(index), 'facultie': FACULTY, 'id': FIRST_GROUP + index})
+    return subs
+
+
+def ingest(s, subs, weeks, concurrency=CONCURRENCY):
+    # Runs the steps of process_sub with the same functions, every stage is timed separately
+    timings = collections.Counter()
+    counters = collections.Counter()
+
+    class timer:
+        def __init__(self, stage):
+            self.stage = stage
+
+        def __enter__(self):
+            self.start = time.perf_counter()
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            timings[self.stage] += time.perf_counter() - self.start
+
+    for sub in subs:
+        with timer('weeks_state'):
+            states = s.get_weeks_state(sub['id'], weeks)
+        with timer('fetch'):
+            pages = collect_weeks_pages(sub['facultie'], sub['id'], weeks, states, concurrency)
+        counters['failed_pages'] += sum(1 for _, page in pages if page is None)
+        result, _ = sync_weeks(s, sub['id'], pages, states, sub_id=str(sub['_id']), timer=timer)
+        result.pop('dates', None)
+        counters.update(result)
+    return timings, counters
+
+
+def run(db, subs, weeks, counter):
+    results = {}
+    s = Studiesdata(db)
+    for phase in ('initial', 'refresh'):
+        counter.commands.clear()
+        start = time.perf_counter()
+        timings, counters = ingest(s, subs, weeks)
+        total = time.perf_counter() - start
+        results[phase] = {
+            'total_s': round(total, 4),
+            'per_subscription_ms': round(total / len(subs) * 1000, 3),
+            'stages_s': {stage: round(value, 4) for stage, value in timings.items()},
+            'mongo_commands': counter.snapshot(),
+            'lessons': dict(counters),
+        }
+    counter.commands.clear()
+    return results
+
+
+def peak_memory(db, subs, weeks):
+    s = Studiesdata(db)
+    tracemalloc.start()
+    ingest(s, subs, weeks)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(peak / 1024 / 1024, 2)
+
+
+def fresh_database(client, name):
+    client.drop_database(name)
+    db = client.get_database(name)
+    ensure_indexes(db)
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline ingestion benchmark')
+    parser.add_argument('--subs', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--weeks', type=int, default=WEEKS)
+    parser.add_argument('--mongo', default=os.environ.get('BENCH_MONGO', 'mongodb://localhost:27017'))
+    parser.add_argument('--db', default='raspisator_bench')
+    parser.add_argument('--output', default=OUTPUT)
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--record', nargs='+', metavar='FACULTY:GROUP')
+    args = parser.parse_args()
+
+    weeks = [week_monday(FIRST_WEEK + timedelta(days=7 * week)) for week in range(args.weeks)]
+    if args.record:
+        record(args.record, weeks)
+        return
+
+    get_session().mount('http://ruz.spbstu.ru/', ReplayAdapter())
+    counter = CommandCounter()
+    client = MongoClient(args.mongo, event_listeners=[counter])
+    report = {'weeks': args.weeks, 'python': sys.version.split()[0], 'mongodb': client.server_info()['version'],
+              'results': {}}
+    for size in args.subs:
+        subs = subscriptions(size)
+        results = run(fresh_database(client, args.db), subs, weeks, counter)
+        if not args.no_memory:
+            results['peak_memory_mib'] = peak_memory(fresh_database(client, args.db), subs, weeks)
+        report['results'][str(size)] = results
+        print('{0:>6} subscriptions: initial {1[initial][total_s]:.2f}s, refresh {1[refresh][total_s]:.2f}s'
+              .format(size, results))
+    client.drop_database(args.db)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+    print('Results are written to {0}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
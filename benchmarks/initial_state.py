@@ -0,0 +1,86 @@
+"""
+Compares INITIAL_STATE extraction: full lxml DOM + regex against the raw bytes extractor.
+
+    python benchmarks/initial_state.py [saved_page.html ...]
+
+Without arguments pages from benchmarks/fixtures are used, or synthetic ones, if there are no fixtures.
+Memory is the growth of peak RSS (VmHWM) of a separate process, which parses the page: libxml2 tree
+lives in C heap, so Python allocations (tracemalloc) don't show it. The page is parsed once to warm up,
+then free heap is returned to the system and the peak is reset by /proc/self/clear_refs, so startup
+doesn't hide the parse. getrusage isn't used: in a spawned child it also keeps the peak of the parent.
+Memory is measured on Linux only.
+"""
+import re
+import sys
+import ctypes
+import timeit
+import subprocess
+
+from common import sample_pages
+
+from collection import extract_initial_state, parse_react_init, find_element
+
+XPATH = '/html/body/script[1]'
+REPEAT = 200
+
+
+def lxml_path(content):
+    return parse_react_init(find_element(content.decode('utf-8'), XPATH))
+
+
+def fast_path(content):
+    return extract_initial_state(content)
+
+
+EXTRACTORS = {'lxml': lxml_path, 'fast': fast_path}
+
+
+def status_kib(field):
+    with open('/proc/self/status') as f:
+        return int(re.search(field + r':\s+(\d+)', f.read()).group(1))
+
+
+def reset_peak_rss():
+    ctypes.CDLL('libc.so.6').malloc_trim(0)
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    return status_kib('VmRSS')
+
+
+def measure_rss(name):
+    # Runs in child process: page is read from stdin, peak RSS growth in KiB is printed
+    content = sys.stdin.buffer.read()
+    # Warm up: code pages and lazy initialization of libraries aren't a cost of every page
+    state = EXTRACTORS[name](content)
+    del state
+    before = reset_peak_rss()
+    state = EXTRACTORS[name](content)
+    after = status_kib('VmHWM')
+    assert state is not None
+    print(after - before)
+
+
+def peak_rss(name, content):
+    if not sys.platform.startswith('linux'):
+        return 'n/a'
+    output = subprocess.run([sys.executable, __file__, '--rss', name], input=content,
+                            stdout=subprocess.PIPE, check=True).stdout
+    return int(output)
+
+
+def main(paths):
+    print('{0:<40} {1:>12} {2:>12} {3:>8} {4:>12} {5:>12}'.format(
+        'page', 'lxml, ms', 'fast, ms', 'speedup', 'lxml, KiB', 'fast, KiB'))
+    for name, content in sample_pages(paths):
+        assert lxml_path(content) == fast_path(content), 'Extractors disagree on {0}'.format(name)
+        slow = timeit.timeit(lambda: lxml_path(content), number=REPEAT) / REPEAT * 1000
+        fast = timeit.timeit(lambda: fast_path(content), number=REPEAT) / REPEAT * 1000
+        print('{0:<40} {1:>12.3f} {2:>12.3f} {3:>7.1f}x {4:>12} {5:>12}'.format(
+            name[-40:], slow, fast, slow / fast, peak_rss('lxml', content), peak_rss('fast', content)))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--rss']:
+        measure_rss(sys.argv[2])
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,89 @@
+"""
+Compares message rendering: Template built from source and emojized output on every call, used before,
+against templates compiled once with emoji aliases resolved in the source.
+
+    python benchmarks/render.py [renders ...]
+
+Each line renders a day of lessons (markdown and plain), the short group title of the inline query and
+the group description of /subs. Outputs of both implementations are compared before timing.
+"""
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+from jinja2 import Template
+from emoji import emojize
+
+from common import ROOT, synthetic_week
+
+# Bot modules are imported without the "app" package, it would connect to databases on import
+sys.path.insert(0, os.path.join(ROOT, 'raspisator', 'app'))
+
+from templates import (lessons_template, short_group, selected_group_message, get_teacher_short,
+                       kind_mapper, type_mapper, _lessons_source, _short_group_source, _selected_group_source)
+
+RENDERS = [100, 1000]
+
+
+def legacy_lessons_template(data, markup=True):
+    # Previous implementations, kept here for comparison only
+    t = Template(_lessons_source(markup))
+    t.globals['short_fio'] = get_teacher_short
+    return emojize(t.render(data=data), use_aliases=True)
+
+
+def legacy_short_group(sub):
+    data = sub.copy()
+    km = dict((v, k) for k, v in kind_mapper.items())
+    tm = dict((v, k) for k, v in type_mapper.items())
+    data['type'] = tm.get(data['type'])
+    data['kind'] = km.get(data['kind'])
+    return emojize(Template(_short_group_source()).render(data=data), use_aliases=True)
+
+
+def legacy_selected_group_message(data, facult=None, use_intro=True):
+    data = data.copy()
+    km = dict((v, k) for k, v in kind_mapper.items())
+    tm = dict((v, k) for k, v in type_mapper.items())
+    data['type'] = tm.get(data['type'])
+    data['kind'] = km.get(data['kind'])
+    return emojize(Template(_selected_group_source(use_intro)).render(data=data, facult=facult), use_aliases=True)
+
+
+def sample_day(group_id=26000):
+    day = synthetic_week(group_id, datetime(2018, 11, 12))[0]
+    date = datetime.strptime(day['date'], '%Y-%m-%d')
+    return [dict(lesson, time_start=date + timedelta(hours=int(lesson['time_start'][:2])),
+                 time_end=date + timedelta(hours=int(lesson['time_end'][:2]), minutes=40))
+            for lesson in day['lessons']]
+
+
+def cases(implementations):
+    lessons_, short_, selected_ = implementations
+    day = sample_day()
+    sub = day[0]['groups'][0]
+    facult = sub['faculty']
+    return {'lessons': lambda: (lessons_(day), lessons_(day, markup=False)),
+            'short_group': lambda: short_(sub),
+            'selected_group': lambda: (selected_(sub, facult), selected_(sub, use_intro=False))}
+
+
+def main(sizes):
+    previous = cases((legacy_lessons_template, legacy_short_group, legacy_selected_group_message))
+    current = cases((lessons_template, short_group, selected_group_message))
+    for name in sorted(current):
+        if previous[name]() != current[name]():
+            print('{0}: outputs differ'.format(name))
+
+    print('{0:<16} {1:>8} {2:>18} {3:>18} {4:>8}'.format('template', 'renders', 'previous, us/call',
+                                                         'current, us/call', 'speedup'))
+    for name in sorted(current):
+        for size in sizes:
+            slow = timeit.timeit(previous[name], number=size) / size * 1e6
+            fast = timeit.timeit(current[name], number=size) / size * 1e6
+            print('{0:<16} {1:>8} {2:>18.1f} {3:>18.1f} {4:>7.1f}x'.format(name, size, slow, fast, slow / fast))
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or RENDERS)
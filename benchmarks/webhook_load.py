@@ -0,0 +1,163 @@
+"""
+Load test of the webhook front end: recorded updates are POSTed concurrently, requests per second
+and latency percentiles of the acknowledgements are reported.
+
+    python benchmarks/webhook_load.py [--updates 5000] [--concurrency 50] [--chats 500] [--handler-ms 20]
+    python benchmarks/webhook_load.py --url https://host/webhook --secret SECRET
+
+Without --url the webhook app is started in a separate thread with a ShardedTeleBot, which handler
+only sleeps --handler-ms, so Telegram, Mongo and Redis aren't needed. Updates are read from
+benchmarks/fixtures/updates/*.json (one update per file or a list of them), synthetic text messages
+are used without fixtures. Update and chat ids are rewritten to spread updates over --chats chats.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import asyncio
+import argparse
+import threading
+import collections
+
+from aiohttp import web, ClientSession
+
+from common import ROOT, FIXTURES
+
+# Bot modules are imported without the "app" package, it would connect to databases on import
+sys.path.insert(0, os.path.join(ROOT, 'raspisator', 'app'))
+
+from dispatcher import ShardedTeleBot
+from webhook import make_app, SECRET_HEADER
+
+SECRET = 'benchmark-secret'
+
+
+def synthetic_update(update_id, chat_id):
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': int(time.time()), 'text': '/start',
+                        'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Bench'},
+                        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'}}}
+
+
+def load_updates(count, chats):
+    recorded = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, 'updates', '*.json'))):
+        with open(path) as f:
+            data = json.load(f)
+        recorded.extend(data if isinstance(data, list) else [data])
+    updates = []
+    for index in range(count):
+        chat_id = 1000 + index % chats
+        if not recorded:
+            updates.append(synthetic_update(index + 1, chat_id))
+            continue
+        update = json.loads(json.dumps(recorded[index % len(recorded)]))
+        update['update_id'] = index + 1
+        for kind in ('message', 'edited_message', 'callback_query', 'inline_query'):
+            if kind in update:
+                update[kind].setdefault('from', {})['id'] = chat_id
+                message = update[kind].get('message') if kind == 'callback_query' else update[kind]
+                if message and 'chat' in message:
+                    message['chat']['id'] = chat_id
+        updates.append(update)
+    return [json.dumps(update) for update in updates]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_local_server(args):
+    bot = ShardedTeleBot('0:benchmark', workers=args.workers, queue_size=args.queue_size)
+    handled = collections.Counter()
+
+    @bot.message_handler(func=lambda message: True)
+    def handle(message):
+        time.sleep(args.handler_ms / 1000.0)
+        handled['messages'] += 1
+
+    port = free_port()
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(make_app(bot, args.secret))
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port).start())
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    time.sleep(0.5)
+    return 'http://127.0.0.1:{0}/webhook'.format(port), bot, handled
+
+
+async def post_all(url, secret, bodies, concurrency):
+    latencies = []
+    statuses = collections.Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {SECRET_HEADER: secret, 'Content-Type': 'application/json'}
+
+    async with ClientSession() as session:
+        async def post(body):
+            async with semaphore:
+                start = time.perf_counter()
+                async with session.post(url, data=body, headers=headers) as response:
+                    await response.read()
+                latencies.append(time.perf_counter() - start)
+                statuses[response.status] += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post(body) for body in bodies))
+        total = time.perf_counter() - start
+    return total, sorted(latencies), statuses
+
+
+def percentile(values, share):
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Webhook load test')
+    parser.add_argument('--url')
+    parser.add_argument('--secret', default=SECRET)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--chats', type=int, default=500)
+    parser.add_argument('--handler-ms', type=float, default=20)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--queue-size', type=int, default=100)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    bot = handled = None
+    url = args.url
+    if not url:
+        url, bot, handled = start_local_server(args)
+    bodies = load_updates(args.updates, args.chats)
+    total, latencies, statuses = asyncio.get_event_loop().run_until_complete(
+        post_all(url, args.secret, bodies, args.concurrency))
+
+    report = {
+        'updates': len(bodies),
+        'concurrency': args.concurrency,
+        'requests_per_second': round(len(bodies) / total, 1),
+        'latency_ms': {name: round(percentile(latencies, share) * 1000, 2)
+                       for name, share in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))},
+        'statuses': {str(status): count for status, count in statuses.items()},
+    }
+    if bot is not None:
+        bot.stop_bot()
+        report['handled'] = handled['messages']
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,12 +6,16 @@ import logging
 from pymongo import MongoClient
 
 from .shared.model import Studiesdata, Userdata
+from .shared.indexes import ensure_indexes
 from .shared.timeworks import next_month, last_month
+from .shared.events import LessonEvents
 
-from .worker import celery, redis
+from .worker import celery, redis, replies
 from .templates import ParseMode, Messages, main_menu, groups_menu, search_menu, main_menu_button
 from .handlers import CommandHandlers, CommandsAliases, InlineHandlers
 from .cache import Cache
+from .days import DayRefresher
+from .dispatcher import ShardedTeleBot
 logger = telebot.logger
 
 locale.setlocale(locale.LC_ALL, ('RU','UTF8'))
@@ -22,9 +26,12 @@ logger.setLevel(logging.DEBUG if os.environ.get('DEBUG', '0') == '1'
 BOT_TOKEN = os.environ.get('BOT_TOKEN', None)
 MONGO_CONNECTION = os.environ.get('MONGO_CONNECTION', 'mongodb://localhost:27017/')
 MONGO_DB = os.environ.get('MONGO_DB', 'raspisator')
+# Updates of different chats are handled in parallel by BOT_WORKERS threads
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', 8))
+BOT_QUEUE_SIZE = int(os.environ.get('BOT_QUEUE_SIZE', 100))
 
 
-bot = telebot.TeleBot(token=BOT_TOKEN, threaded=False)
+bot = ShardedTeleBot(token=BOT_TOKEN, workers=BOT_WORKERS, queue_size=BOT_QUEUE_SIZE)
 logger.warning('Initalizing bot with token: {0}'.format("<SANTINIZED>" if BOT_TOKEN != None else "<EMPTY>"))
 
 conn = MongoClient(MONGO_CONNECTION)
@@ -32,9 +39,14 @@ logger.warning("Database connected" if 'ok' in conn.server_info() and
                                      conn.server_info()['ok'] == 1.0 else "Database connection failed!")
 
 db = conn.get_database(MONGO_DB)
+ensure_indexes(db)
 studiesmodel = Studiesdata(db)
 usersmodel = Userdata(db)
 cache = Cache(redis)
+# Results of teacher tasks continue dialogs in the threads of their chats
+replies.start(bot.dispatcher.submit)
+# Cached days are dropped and rendered again, when worker stores changed lessons
+DayRefresher(LessonEvents(redis), studiesmodel, cache).start()
 
 
 handlers = CommandHandlers(bot,
@@ -59,7 +71,8 @@ InlineHandlers(bot,
 from .markups import gen_inline_groups_markup
 @bot.inline_handler(lambda query: query.query == '')
 def query_text(inline_query):
-    subs = usersmodel.get_subscriptions(tel_user=inline_query.from_user.id)
+    subs = [sub for sub in usersmodel.get_subscriptions(tel_user=inline_query.from_user.id) if sub]
+    cache.touch_subscriptions(subs)
     lessons = [studiesmodel.get_nearest_lesson(sub['id']) for sub in subs]
     groups_inline = gen_inline_groups_markup(subs, lessons)
     bot.answer_inline_query(inline_query.id, groups_inline)
@@ -86,11 +99,21 @@ def _(message):
     resp = celery.send_task('deferred.get_groups_schema')
     bot.send_message(message.chat.id, 'Schema will be updated! Task: "{0}"'.format(str(resp)))
 
+@bot.message_handler(func= lambda message: message.text == 'refresh-all-subs')
+def _(message):
+    resp = celery.send_task('deferred.get_all_subscibtions_data', kwargs={'force': True})
+    bot.send_message(message.chat.id, 'All subscriptions will be refreshed! Task: "{0}"'.format(str(resp)))
+
 @bot.message_handler(func= lambda message: message.text == 'purge-unused-subs')
 def _(message):
     resp = celery.send_task('deferred.unlink_non_used_subs')
     bot.send_message(message.chat.id, 'Unused subs will be removed! Task: "{0}"'.format(str(resp)))
 
+@bot.message_handler(func= lambda message: message.text == 'audit-query-plans')
+def _(message):
+    resp = celery.send_task('deferred.audit_query_plans')
+    bot.send_message(message.chat.id, 'Query plans will be audited! Task: "{0}"'.format(str(resp)))
+
 @bot.message_handler(func= lambda message: message.text == 'purge-timeouts')
 def _(message):
     resp = celery.send_task('deferred.purge_subscription_timeouts')
@@ -2,6 +2,9 @@
 from redis import Redis
 from datetime import timedelta, datetime
 import json
+import time
+
+from .shared.schedule import RefreshSchedule
 
 def _week(uid):
     return 'week-{0}'.format(uid)
@@ -12,10 +15,62 @@ def _cal(uid):
 def _gr(uid):
     return 'group-{0}'.format(uid)
 
+def _day(group_id, date):
+    return 'day-{0}-{1}'.format(group_id, date.strftime('%Y-%m-%d'))
+
+# Rendered days are invalidated by lessons changes, expiration only limits staleness after missed events
+DAY_TTL = 60 * 60 * 12
+# Activity of subscription is written once per interval by every bot process, it is counted in days
+TOUCH_INTERVAL = 5 * 60
+
+# Current group is kept as "<subscription id>:<group id>", day of the group is read in the same call.
+# Day key is built as _day does it
+_CURRENT_DAY = """
+local current = redis.call('GET', KEYS[1])
+if not current then
+    return {false, false}
+end
+local group = string.match(current, ':(%d+)$')
+if not group then
+    return {current, false}
+end
+return {current, redis.call('GET', 'day-' .. group .. '-' .. ARGV[1])}
+"""
+
 class Cache:
 
     def __init__(self, redis: Redis):
         self.r = redis
+        self.schedule = RefreshSchedule(redis)
+        self._current_day = redis.register_script(_CURRENT_DAY)
+        self._touched = {}
+
+    def touch_subscriptions(self, subs):
+        # Subscriptions of active users are refreshed more often
+        now = time.time()
+        sub_ids = [str(sub['_id']) for sub in subs
+                   if sub and now - self._touched.get(str(sub['_id']), 0) >= TOUCH_INTERVAL]
+        if not sub_ids:
+            return None
+        for sub_id in sub_ids:
+            self._touched[sub_id] = now
+        return self.schedule.touch(sub_ids)
+
+    def get_days(self, group_ids, date):
+        # Rendered day of every group, None if it isn't cached
+        if not group_ids:
+            return []
+        return [json.loads(raw.decode('utf-8')) if raw else None
+                for raw in self.r.mget([_day(group_id, date) for group_id in group_ids])]
+
+    def set_day(self, group_id, date, day, overwrite=True):
+        # Days rendered on user request don't overwrite ones, written after lessons change
+        return self.r.set(_day(group_id, date), json.dumps(day), ex=DAY_TTL, nx=not overwrite)
+
+    def drop_days(self, group_id, dates):
+        if not dates:
+            return 0
+        return self.r.delete(*[_day(group_id, date) for date in dates])
 
     def set_user_week(self, user_id, week_monday):
         return self.r.set(_week(user_id), week_monday.strftime("%Y-%m-%d %H:%M"))
@@ -45,15 +100,24 @@ class Cache:
         else:
             return c
 
-    def set_user_curr_gr(self, user_id, group):
-        return self.r.set(_gr(user_id), group)
+    def set_user_curr_gr(self, user_id, sub_id, group_id):
+        return self.r.set(_gr(user_id), '{0}:{1}'.format(sub_id, group_id))
+
+    def get_user_curr_day(self, user_id, date):
+        # Returns current subscription of the user and its rendered day, both could be None
+        current, day = self._current_day(keys=[_gr(user_id)], args=[date.strftime('%Y-%m-%d')])
+        sub_id = current.decode('utf-8').split(':')[0] if current else None
+        return sub_id, json.loads(day.decode('utf-8')) if day else None
+
+    def drop_user_curr_gr(self, user_id):
+        return self.r.delete(_gr(user_id))
 
     def get_user_curr_gr(self, user_id):
         try:
             msg = self.r.get(_gr(user_id))
             if not msg:
                 return None
-            g = msg.decode('utf-8')
+            g = msg.decode('utf-8').split(':')[0]
         except TypeError:
             return None
         else:
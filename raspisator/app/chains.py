@@ -12,6 +12,29 @@ class Retry(Exception):
 class NoMarkupError(Exception):
     pass
 
+
+class Pending:
+    # Returned by dialog step instead of kwargs, when step waits for a result of background task.
+    # continuation(result) finishes the step: returns kwargs for the next step or raises Retry
+    def __init__(self, continuation):
+        self.continuation = continuation
+        self._callback = None
+        self._resolved = False
+        self._value = None
+
+    def resolve(self, value):
+        # Must be called in the thread of the chat, so subscribe and resolve are never run concurrently
+        if self._resolved:
+            return
+        self._resolved, self._value = True, value
+        if self._callback:
+            self._callback(value)
+
+    def subscribe(self, callback):
+        self._callback = callback
+        if self._resolved:
+            callback(self._value)
+
 def decor(method=None):
     # If called without method, we've been called with optional arguments.
     # We return a decorator with the optional arguments filled in.
@@ -36,7 +59,8 @@ def decor(method=None):
                     return self.main_menu(message)
 
                 if self._previous.markup:
-                    self.bot.send_message(message.chat.id, self._previous.description, reply_markup=self._previous.markup.body)
+                    self.bot.send_message(message.chat.id, self._previous.description,
+                                          reply_markup=self._previous.markup_body(kwargs))
                 self.bot.register_next_step_handler_by_chat_id(message.chat.id, self._previous, **kwargs)
                 return
 
@@ -47,16 +71,25 @@ def decor(method=None):
             # if self.markup and self.description:
             #     self.bot.send_message(message.chat.id, self.description, reply_markup=self.markup)
 
+            # global values need to be redifined
+            kwargs = {**kwargs, **self.globals}
+            self._proceed(message, lambda: self.method(self.bot, message, **kwargs), kwargs)
+
+        def _proceed(self, message, step, kwargs):
             try:
-                # global values need to be redifined
-                kwargs = {**kwargs, **self.globals}
-                kwargs = self.method(self.bot, message, **kwargs)
+                result = step()
             except Retry as r:
                 print('Retry was raised in "{0}"'.format(self.description))
-                self.bot.send_message(message.chat.id, str(r), reply_markup=self.markup.body)
+                self.bot.send_message(message.chat.id, str(r), reply_markup=self.markup_body(kwargs))
                 self.bot.register_next_step_handler_by_chat_id(message.chat.id, self, **kwargs)
                 return
 
+            if isinstance(result, Pending):
+                # Step waits for background result, dialog goes on when continuation returns
+                result.subscribe(lambda value: self._resume(message, result, value, kwargs))
+                return
+            kwargs = result
+
             if not self._next:
                 return self.main_menu(message)
 
@@ -64,20 +97,34 @@ def decor(method=None):
                 raise NoMarkupError("No markup aviable for step")
 
             if isinstance(self._next.markup, DynamicMarkup):
-                next_mkp = kwargs.get('next_step_markup')
+                # Steps are shared by chats handled in parallel, so markup, built for this chat,
+                # is kept in kwargs of the chat: Retry and Back show it again
+                next_mkp = kwargs.pop('next_step_markup', None)
                 if next_mkp:
-                    self._next.markup.set_body(next_mkp)
-                    del kwargs['next_step_markup']
-                elif self._next.markup.body != None:
-                    pass
+                    markups = dict(kwargs.get('step_markups', {}))
+                    markups[self._next] = next_mkp
+                    kwargs['step_markups'] = markups
                 else:
+                    next_mkp = self._next.markup_body(kwargs)
+                if next_mkp is None:
                     raise NoMarkupError("No markup aviable for step")
 
-                self.bot.send_message(message.chat.id, self._next.description, reply_markup=self._next.markup.body)
+                self.bot.send_message(message.chat.id, self._next.description, reply_markup=next_mkp)
             else:
                 self.bot.send_message(message.chat.id, 'Ашипка', reply_markup=types.ReplyKeyboardRemove(selective=False))
             self.bot.register_next_step_handler_by_chat_id(message.chat.id, self._next, **kwargs)
 
+        def _resume(self, message, pending, value, kwargs):
+            # User, who has sent anything after the step (main menu, another command or dialog),
+            # has left the dialog: late result mustn't take the chat over
+            if self.bot.last_message_id(message.chat.id) != message.message_id:
+                print('Result of "{0}" is dropped, dialog was left'.format(self.description))
+                return
+            self._proceed(message, lambda: pending.continuation(value), kwargs)
+
+        def markup_body(self, kwargs):
+            return kwargs.get('step_markups', {}).get(self, self.markup.body)
+
         def set_bot(self, bot):
             self.bot = bot
 
@@ -155,15 +202,13 @@ class Dialog:
 
 
 class DynamicMarkup:
+    # Body is built by previous step for each chat and passed in kwargs
     def __init__(self):
         self.body = None
 
-    def set_body(self, markup):
-        self.body = markup
-
 class StaticMarkup(DynamicMarkup):
     def __init__(self, body):
-        self.set_body(body)
+        self.body = body
 #
 # def handle_init(message):
 #     d = Dialog()
@@ -0,0 +1,62 @@
+import time
+import threading
+from datetime import datetime, timedelta
+
+import telebot
+from pymongo.errors import PyMongoError
+from redis.exceptions import RedisError
+
+from .templates import lessons_template
+
+logger = telebot.logger
+
+WRITE_THROUGH_DAYS = 14
+
+
+def render_day(studiesmodel, group_id, date):
+    # Both texts are kept: markdown is sent, plain one is compared with shown message
+    lessons = studiesmodel.get_lessons_in_day(group_id, date)
+    if not lessons:
+        return {'md': None, 'plain': None}
+    return {'md': lessons_template(lessons), 'plain': lessons_template(lessons, markup=False)}
+
+
+class DayRefresher:
+    # Follows lessons changes stream: changed days of the group are dropped from cache,
+    # all days in the next WRITE_THROUGH_DAYS of active subscriptions are rendered again at once
+    def __init__(self, events, studiesmodel, cache, days=WRITE_THROUGH_DAYS):
+        self.events = events
+        self.s = studiesmodel
+        self.cache = cache
+        self.days = days
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._listen, name='DayRefresher', daemon=True)
+        self.thread.start()
+
+    def refresh(self, event, today=None):
+        today = today or datetime.combine(datetime.now().date(), datetime.min.time())
+        dates = [datetime.combine(date, datetime.min.time()) for date in event['dates']]
+        self.cache.drop_days(event['group'], dates)
+        if not self.cache.schedule.is_active(event['sub']):
+            return 0
+        # Subscription was just refreshed, days, expired or never rendered, are written too
+        for offset in range(self.days):
+            date = today + timedelta(days=offset)
+            self.cache.set_day(event['group'], date, render_day(self.s, event['group'], date))
+        return self.days
+
+    def _listen(self):
+        last_id = None
+        while True:
+            try:
+                if last_id is None:
+                    # Days, changed before start, are limited by cache expiration
+                    last_id = self.events.last_id()
+                for event_id, event in self.events.read(last_id, block=5000):
+                    self.refresh(event)
+                    last_id = event_id
+            except (RedisError, PyMongoError) as e:
+                logger.error('Day refresher failed: {0}'.format(e))
+                time.sleep(1)
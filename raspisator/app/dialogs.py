@@ -11,7 +11,7 @@ from .markups import *
 from .chains import Retry
 from .shared.timeworks import convert_concat_day_and_lesson
 
-from .worker import celery
+from .worker import celery, search_teachers, get_teacher_lessons
 
 
 def handle_facultie_group_selection(bot, message, **kwargs):
@@ -108,40 +108,39 @@ def handle_group_commit(bot, message, **kwargs):
 def handle_teacher_name(bot, message, **kwargs):
     "Введите имя преподавателя:"
 
-    result = celery.send_task('deferred.get_teacher_search', args=[message.text])
     bot.send_chat_action(message.chat.id, 'typing')
-    # result = get_teacher_search.delay(message.text)
     bot.send_message(message.chat.id, 'Произвожу поиск...')
-    result = result.wait(timeout=10)
-    if not result:
-        raise Retry('Поиск не дал результатов! Введите другой запрос, или вернитесь в меню /main')
 
-    kwargs.update({'next_step_markup': gen_list_markup(result, 'full_name')})
-    kwargs.update({'teachers': result})
-    return kwargs
+    def found(result):
+        if not result:
+            raise Retry('Поиск не дал результатов! Введите другой запрос, или вернитесь в меню /main')
+        kwargs.update({'next_step_markup': gen_list_markup(result, 'full_name')})
+        kwargs.update({'teachers': result})
+        return kwargs
+
+    return search_teachers(message.text, message.chat.id, found)
 
 def handle_teacher_selection(bot, message, **kwargs):
     "Выберите преподавателя из списка:"
 
-    result =None
+    def found(result):
+        if not result:
+            raise Retry('Для этого преподавателя нет расписания!')
+
+        dates_list = []
+        for item in result:
+            dates_list.append(Messages.teacher_date_templ(datetime.strptime(item['date'], '%Y-%m-%d')))
+
+        kwargs.update({'next_step_markup': gen_list_markup(dates_list)})
+        kwargs.update({'teacher_rasp': result})
+        return kwargs
+
     teachers = kwargs.get('teachers')
     for teacher in teachers:
         if teacher['full_name'] == message.text:
-            result = celery.send_task('deferred.get_teacher_lessons', args=[teacher['id']])
             bot.send_chat_action(message.chat.id, 'typing')
-            # result = get_teacher_lessons.delay(teacher['id'])
-            result = result.wait(timeout=10)
-
-    if not result:
-        raise Retry('Для этого преподавателя нет расписания!')
-
-    dates_list = []
-    for item in result:
-        dates_list.append(Messages.teacher_date_templ(datetime.strptime(item['date'], '%Y-%m-%d')))
-
-    kwargs.update({'next_step_markup': gen_list_markup(dates_list)})
-    kwargs.update({'teacher_rasp': result})
-    return kwargs
+            return get_teacher_lessons(teacher['id'], message.chat.id, found)
+    return found(None)
 
 
 def handle_teacher_date(bot, message, **kwargs):
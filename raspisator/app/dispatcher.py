@@ -0,0 +1,96 @@
+import queue
+import threading
+
+import telebot
+
+logger = telebot.logger
+
+_STOP = object()
+
+
+class ChatDispatcher:
+    # Every chat is bound to one worker thread, so updates of a chat are handled in order,
+    # while different chats are handled in parallel. Queues are bounded: when they are full,
+    # polling waits instead of piling updates in memory.
+    def __init__(self, workers=8, queue_size=100):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        self.threads = [threading.Thread(target=self._work, args=(q,), name='ChatWorker-{0}'.format(i), daemon=True)
+                        for i, q in enumerate(self.queues)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, chat_id, fn, *args, block=True, **kwargs):
+        # Returns False, when queue of the chat is full and block is False
+        try:
+            self.queues[hash(chat_id) % len(self.queues)].put((fn, args, kwargs), block=block)
+        except queue.Full:
+            return False
+        return True
+
+    def stop(self, timeout=None):
+        # Already queued updates are handled before threads exit
+        for q in self.queues:
+            q.put(_STOP)
+        for thread in self.threads:
+            thread.join(timeout)
+
+    @staticmethod
+    def _work(q):
+        while True:
+            task = q.get()
+            if task is _STOP:
+                return
+            fn, args, kwargs = task
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                logger.exception('Update handling failed')
+
+
+def update_chat_id(update):
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message:
+            return message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    for query in (update.inline_query, update.chosen_inline_result, update.shipping_query,
+                  update.pre_checkout_query):
+        if query:
+            return query.from_user.id
+    return None
+
+
+class ShardedTeleBot(telebot.TeleBot):
+    # Handlers are run by ChatDispatcher instead of telebot's own worker pool, which doesn't keep order
+    def __init__(self, token, workers=8, queue_size=100, **kwargs):
+        super().__init__(token, threaded=False, **kwargs)
+        self.dispatcher = ChatDispatcher(workers, queue_size)
+        self._last_messages = {}
+
+    def process_new_updates(self, updates):
+        # Offset is moved here, in polling thread, so handlers in worker threads never change it
+        for update in updates:
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+        for update in updates:
+            self.enqueue_update(update)
+
+    def process_new_messages(self, new_messages):
+        # Runs in the thread of the chat, before any handler of the messages
+        for message in new_messages:
+            self._last_messages[message.chat.id] = message.message_id
+        super().process_new_messages(new_messages)
+
+    def last_message_id(self, chat_id):
+        # Id of the last message of the chat, handled by this process
+        return self._last_messages.get(chat_id)
+
+    def enqueue_update(self, update, block=True):
+        return self.dispatcher.submit(update_chat_id(update), super().process_new_updates, [update], block=block)
+
+    def stop_bot(self):
+        # Not threaded TeleBot has no worker_pool, which base stop_bot closes
+        self.stop_polling()
+        self.dispatcher.stop()
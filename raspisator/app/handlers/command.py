@@ -36,6 +36,7 @@ class CommandHandlers(HandleMiddleware):
         username = message.from_user.username if message.from_user.username else message.from_user.first_name
         user = self.u.create_or_get_user(message.from_user.id, username)
         subs = list(self.u.get_subscriptions(db_user=user))
+        self.cache.touch_subscriptions(subs)
         return user, subs
 
     def start_handler(self, message):
@@ -119,11 +120,11 @@ class CommandHandlers(HandleMiddleware):
         date = (now.year, now.month)
         self.cache.set_user_cal(message.from_user.id, date)
         default_group = self.u.get_user_default_group(message.from_user.id)
-        self.cache.set_user_curr_gr(message.from_user.id, default_group)
         sub, _ = self.u.get_user_subscription_settings(
                 message.from_user.id,
                 default_group
         )
+        self.cache.set_user_curr_gr(message.from_user.id, default_group, sub['id'])
         markup = create_calendar_inline(now.year, now.month, sub['name'])
         self.bot.send_message(message.chat.id, Messages.select_date, reply_markup=markup)
 
@@ -139,10 +140,10 @@ class CommandHandlers(HandleMiddleware):
     def week_handler(self, message):
         self.cache.set_user_week(message.from_user.id, datetime.now())
         default_group = self.u.get_user_default_group(message.from_user.id)
-        self.cache.set_user_curr_gr(message.from_user.id, default_group)
         sub, _ = self.u.get_user_subscription_settings(
                 message.from_user.id,
                 default_group
         )
+        self.cache.set_user_curr_gr(message.from_user.id, default_group, sub['id'])
         week_markup = create_week_inline(datetime.now(), sub['name'])
         self.bot.send_message(message.chat.id, Messages.select_date, reply_markup=week_markup)
@@ -7,9 +7,16 @@ from ..markups import create_group_settings_markup, gen_groups_settings_markup,
     create_week_inline, create_month_back_inline, create_calendar_inline, \
     gen_groups_choice_markup
 
-from ..templates import selected_group_message, lessons_template, ParseMode, Messages
+from ..templates import selected_group_message, ParseMode, Messages
+from ..days import render_day
 from ..shared.timeworks import next_weekday, last_weekday, next_month, last_month
 
+def _day_texts(days):
+    for day in days:
+        if day['md']:
+            return day['md'], day['plain']
+    return Messages.no_schedule_on_date, Messages.no_schedule_on_date
+
 class InlineParser(HandleMiddleware):
     __prefix__ = None
 
@@ -30,23 +37,31 @@ class InlineParser(HandleMiddleware):
                 # print('User "{0}" call inline "{1}" args={2}'.format(call.from_user.id, self.__prefix__+'-'+method[0], args))
                 return method[1](call, *args)
 
-    def _get_user_lessons_by_date(self, uid, date, markup=True):
-        lessons = []
-        sub_id = self.cache.get_user_curr_gr(uid)
-        for sub in self.u.get_subscriptions(tel_user=uid, sub_id=sub_id):
-            lessons.append(self.s.get_lessons_in_day(sub["id"], date))
-
-        if all([lesson == [] for lesson in lessons]):
-            return Messages.no_schedule_on_date
+    def _get_user_day(self, uid, date):
+        # Returns markdown and plain texts of the day. Day of current group is taken by one cache read,
+        # subscriptions are queried only when it isn't cached. Current group is a subscription of the user:
+        # it is replaced, when user unsubscribes
+        sub_id, day = self.cache.get_user_curr_day(uid, date)
+        if day is not None:
+            self.cache.touch_subscriptions([{'_id': sub_id}])
+            return _day_texts([day])
+
+        subs = [sub for sub in self.u.get_subscriptions(tel_user=uid, sub_id=sub_id) if sub]
+        self.cache.touch_subscriptions(subs)
+        if sub_id and subs:
+            # Current group, selected before its group id was kept with it
+            self.cache.set_user_curr_gr(uid, sub_id, subs[0]['id'])
+        days = self.cache.get_days([sub['id'] for sub in subs], date)
+        for index, sub in enumerate(subs):
+            if days[index] is None:
+                days[index] = render_day(self.s, sub['id'], date)
+                self.cache.set_day(sub['id'], date, days[index], overwrite=False)
+        return _day_texts(days)
 
-        for lesson in lessons:
-            if lesson == []:
-                continue
-            return lessons_template(lesson, markup)
+    @staticmethod
+    def same_message(remote, local):
+        return local.split() == remote.split()
 
-    def same_message(self, remote, uid, date):
-        local = self._get_user_lessons_by_date(uid, date, markup=False)
-        return  local.split() == remote.split()
 
 class SettingsInline(InlineParser):
     __prefix__ = 'settings'
@@ -67,6 +82,14 @@ class SettingsInline(InlineParser):
 
     def unsub(self, call, *args):
         self.u.delete_subscription(call.from_user.id, args[0])
+        if self.cache.get_user_curr_gr(call.from_user.id) == args[0]:
+            # Removed group mustn't be shown or kept active, default group becomes current one
+            default_group = self.u.get_user_default_group(call.from_user.id)
+            if default_group:
+                sub, _ = self.u.get_user_subscription_settings(call.from_user.id, default_group)
+                self.cache.set_user_curr_gr(call.from_user.id, default_group, sub['id'])
+            else:
+                self.cache.drop_user_curr_gr(call.from_user.id)
         subs = list(self.u.get_subscriptions(tel_user=call.from_user.id))
         self.bot.answer_callback_query(call.id, text=Messages.removed_group())
         self.bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id,
@@ -146,8 +169,9 @@ class WeekSwithcer(InlineParser):
         uid = call.from_user.id
         date = datetime.strptime(args[0], "%Y.%m.%d")
         saved_date = self.cache.get_user_week(uid)
-        if not self.same_message(call.message.text, uid, date):
-            self.bot.edit_message_text(self._get_user_lessons_by_date(uid, date),
+        text, plain = self._get_user_day(uid, date)
+        if not self.same_message(call.message.text, plain):
+            self.bot.edit_message_text(text,
                                   uid, call.message.message_id,
                                   reply_markup=self._create_week_inline(uid, saved_date),
                                   parse_mode=ParseMode.MARKDOWN,
@@ -197,8 +221,9 @@ class CalendarDialog(InlineParser):
             uid = call.from_user.id
             day = args[0]
             date = datetime(int(saved_date[0]), int(saved_date[1]), int(day), 0, 0, 0)
-            if not self.same_message(call.message.text, uid, date):
-                self.bot.edit_message_text(self._get_user_lessons_by_date(uid, date),
+            text, plain = self._get_user_day(uid, date)
+            if not self.same_message(call.message.text, plain):
+                self.bot.edit_message_text(text,
                                   uid, call.message.message_id,
                                   reply_markup=create_month_back_inline(date),
                                   parse_mode=ParseMode.MARKDOWN)
@@ -230,7 +255,10 @@ class CurrrentGroupSwitcher(InlineParser):
             self.bot.answer_callback_query(call.id, text=Messages.already_current_group)
             return
 
-        self.cache.set_user_curr_gr(call.from_user.id, to_select)
+        sub, _ = self.u.get_user_subscription_settings(call.from_user.id, to_select)
+        if not sub:
+            return
+        self.cache.set_user_curr_gr(call.from_user.id, to_select, sub['id'])
         self.bot.answer_callback_query(call.id, text=Messages.group_select_succeed)
         self._respond_mock(call, self._create_changegroup_markup(call.from_user.id, *args[1:]))
 
@@ -0,0 +1,73 @@
+import time
+import threading
+
+import telebot
+from redis.exceptions import RedisError
+
+logger = telebot.logger
+
+
+class ReplyListener:
+    # Receives results of background tasks from redis channel and passes them to waiting dialogs.
+    # Waiters, which got no reply in time, are resolved with None.
+    def __init__(self, redis, channel, parse):
+        self.r = redis
+        self.channel = channel
+        self.parse = parse
+        self.dispatch = None
+        self.waiters = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, dispatch):
+        # dispatch(chat_id, fn, *args) runs fn in the thread of the chat
+        self.dispatch = dispatch
+        self.thread = threading.Thread(target=self._listen, name='ReplyListener', daemon=True)
+        self.thread.start()
+
+    def wait(self, key, chat_id, pending, timeout):
+        with self.lock:
+            self.waiters.setdefault(key, []).append((chat_id, pending, time.time() + timeout))
+
+    def cancel(self, key, pending):
+        with self.lock:
+            waiters = [waiter for waiter in self.waiters.get(key, []) if waiter[1] is not pending]
+            if waiters:
+                self.waiters[key] = waiters
+            else:
+                self.waiters.pop(key, None)
+
+    def _resolve(self, waiters, value):
+        for chat_id, pending, _ in waiters:
+            self.dispatch(chat_id, pending.resolve, value)
+
+    def _expire(self):
+        now = time.time()
+        expired = []
+        with self.lock:
+            for key in list(self.waiters):
+                waiting = [waiter for waiter in self.waiters[key] if waiter[2] > now]
+                expired.extend(waiter for waiter in self.waiters[key] if waiter[2] <= now)
+                if waiting:
+                    self.waiters[key] = waiting
+                else:
+                    del self.waiters[key]
+        self._resolve(expired, None)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message and message['type'] == 'message':
+                        key, value = self.parse(message['data'])
+                        with self.lock:
+                            waiters = self.waiters.pop(key, [])
+                        self._resolve(waiters, value)
+                    self._expire()
+            except (RedisError, ValueError, KeyError) as e:
+                logger.error('Reply listener failed: {0}'.format(e))
+                self._expire()
+                time.sleep(1)
@@ -1,4 +1,4 @@
-from jinja2 import Template
+from jinja2 import Environment
 from emoji import emojize
 
 def emoj(string: str) -> str:
@@ -91,7 +91,7 @@ def get_teacher_short(teacher_data):
         return ''
 
 
-def lessons_template(data, markup=True):
+def _lessons_source(markup):
     text = ""
     # TODO: Add groups to text, if group list different
     text += "{% if data[0] %}\n:calendar: "
@@ -115,40 +115,19 @@ def lessons_template(data, markup=True):
     text+= "{% if lesson['teachers'] %} ({{ short_fio(lesson['teachers'][0]) }}){% endif %}"
     # text +=  "{{ day['addr'] }}, {{ day['room'] }} ({{ day['teacher'] }})\n\n"
     text += "\n{% endfor %}"
-    t = Template(text)
-    t.globals['short_fio'] = get_teacher_short
-    message = emoj(t.render(data=data))
-    return message
+    return text
 
 
-def short_group(sub):
-    data = sub.copy()
-    km = dict((v, k) for k, v in kind_mapper.items())
-    tm = dict((v, k) for k, v in type_mapper.items())
-    data['type'] = tm.get(data['type'])
-    data['kind'] = km.get(data['kind'])
+def _short_group_source():
     text = ""
     text += "{% if data['kind'] %}:mortar_board: {{ data['kind'] }} {% endif %}"
     text += "{% if data['type'] %}:pencil2:{{ data['type'] }} {% endif %}"
     text += ":books: {{ data['level']}} "
     text += ":school_satchel: {{ data['name'] }}"
+    return text
 
-    t = Template(text)
-    message = emojize(t.render(data=data), use_aliases=True)
-    return message
-
-
-def selected_group_message(data, facult=None, use_intro=True):
-    data = data.copy()
-    if facult:
-        facult = facult.copy()
-
-    km = dict((v, k) for k, v in kind_mapper.items())
-    tm = dict((v, k) for k, v in type_mapper.items())
-
-    data['type'] = tm.get(data['type'])
-    data['kind'] = km.get(data['kind'])
 
+def _selected_group_source(use_intro):
     if use_intro:
         text = "*Вы выбрали* :mag:\n"
     else:
@@ -160,9 +139,38 @@ def selected_group_message(data, facult=None, use_intro=True):
     text += "{% if data['type'] %}:pencil2: *Форма обучения :* {{ data['type'] }}\n{% endif %}"
     text += ":books: *Курс:* {{ data['level']}}\n"
     text += ":school_satchel: *Группа:* {{ data['name'] }}"
+    return text
+
+
+# Templates are compiled once, emoji aliases are replaced in the source, so rendered text isn't emojized
+env = Environment()
+env.globals['short_fio'] = get_teacher_short
+
+kind_names = dict((v, k) for k, v in kind_mapper.items())
+type_names = dict((v, k) for k, v in type_mapper.items())
+
+registry = {
+    'lessons': {markup: env.from_string(emoj(_lessons_source(markup))) for markup in (True, False)},
+    'short_group': env.from_string(emoj(_short_group_source())),
+    'selected_group': {use_intro: env.from_string(emoj(_selected_group_source(use_intro)))
+                       for use_intro in (True, False)},
+}
+
+
+def _group_names(sub):
+    data = sub.copy()
+    data['type'] = type_names.get(data['type'])
+    data['kind'] = kind_names.get(data['kind'])
+    return data
 
-    t = Template(text)
 
-    message = emojize(t.render(data=data, facult=facult), use_aliases=True)
-    return message
+def lessons_template(data, markup=True):
+    return registry['lessons'][bool(markup)].render(data=data)
 
+
+def short_group(sub):
+    return registry['short_group'].render(data=_group_names(sub))
+
+
+def selected_group_message(data, facult=None, use_intro=True):
+    return registry['selected_group'][bool(use_intro)].render(data=_group_names(data), facult=facult)
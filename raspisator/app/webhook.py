@@ -0,0 +1,53 @@
+import hmac
+import json
+
+import requests
+import telebot
+from aiohttp import web
+from telebot import types
+
+logger = telebot.logger
+
+API_URL = 'https://api.telegram.org/bot{0}/{1}'
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def make_app(bot, secret, path='/webhook'):
+    # bot must have enqueue_update(update, block) method, see ShardedTeleBot.
+    # Update is only queued here, Telegram gets its answer before handlers are run
+    if not secret:
+        raise ValueError('Webhook secret token is required')
+
+    async def handle(request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), secret):
+            return web.Response(status=403)
+        try:
+            update = types.Update.de_json(await request.text())
+        except (ValueError, KeyError) as e:
+            logger.error('Malformed update: {0}'.format(e))
+            return web.Response(status=400)
+        if not bot.enqueue_update(update, block=False):
+            # Queue of the chat is full, Telegram will repeat the update later
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    return app
+
+
+def set_webhook(token, url, secret, max_connections=40):
+    response = requests.post(API_URL.format(token, 'setWebhook'), timeout=10,
+                             json={'url': url, 'secret_token': secret, 'max_connections': max_connections})
+    result = response.json()
+    if not result.get('ok'):
+        raise RuntimeError('Webhook is not set: {0}'.format(json.dumps(result)))
+    return result
+
+
+def run_webhook(bot, url, secret, host='0.0.0.0', port=8080, path='/webhook'):
+    # App is made first: webhook without secret token must not be registered in Telegram
+    app = make_app(bot, secret, path)
+    set_webhook(bot.token, url, secret)
+    logger.info('Webhook is set to {0}, listening on {1}:{2}{3}'.format(url, host, port, path))
+    web.run_app(app, host=host, port=port)
@@ -1,8 +1,13 @@
 
 import os
+from uuid import uuid4
 from celery import Celery
 from redis import Redis
 
+from .shared.teachers import TeacherCache, SEARCH, SCHEDULE
+from .chains import Pending
+from .replies import ReplyListener
+
 CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0'),
 CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND', 'redis://localhost:6379/1')
 REDIS_CACHE = os.environ.get('REDIS_CACHE', 'redis://localhost:6379/2')
@@ -10,4 +15,32 @@ REDIS_CACHE = os.environ.get('REDIS_CACHE', 'redis://localhost:6379/2')
 celery = Celery(broker=CELERY_BROKER_URL,
              backend=CELERY_RESULT_BACKEND,
              )
-redis = Redis.from_url(REDIS_CACHE)
\ No newline at end of file
+redis = Redis.from_url(REDIS_CACHE)
+teachers = TeacherCache(redis)
+replies = ReplyListener(redis, teachers.replies_channel, teachers.parse_reply)
+
+
+def _teacher_data(task, kind, arg, chat_id, continuation, timeout):
+    # Returns Pending at once: it is resolved by cached value, or by reply of the task, when it is finished.
+    # Waiter is registered before cache lookup, so reply, published right after lookup, isn't missed
+    pending = Pending(continuation)
+    key = teachers.reply_key(kind, arg)
+    replies.wait(key, chat_id, pending, timeout)
+    hit, result = teachers.lookup(kind, arg)
+    if hit:
+        replies.cancel(key, pending)
+        pending.resolve(result)
+        return pending
+    task_id = str(uuid4())
+    # Identical running task will answer too, only one task is sent
+    if teachers.claim(kind, arg, task_id) is None:
+        celery.send_task(task, args=[arg], task_id=task_id)
+    return pending
+
+
+def search_teachers(name, chat_id, continuation, timeout=30):
+    return _teacher_data('deferred.get_teacher_search', SEARCH, name, chat_id, continuation, timeout)
+
+
+def get_teacher_lessons(teacher_id, chat_id, continuation, timeout=30):
+    return _teacher_data('deferred.get_teacher_lessons', SCHEDULE, teacher_id, chat_id, continuation, timeout)
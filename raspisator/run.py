@@ -2,11 +2,21 @@
 # bot.infinity_polling(timeout=10, none_stop=True)
 
 # bot.polling(timeout=10)
+import os
 import time
 import sys, traceback
 
+# Webhook mode is used, when public url is given, long polling otherwise
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8080))
+
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    sys.exit('WEBHOOK_SECRET is required, when WEBHOOK_URL is set')
+
 from telebot import logger, apihelper
 from app import bot
+from app.webhook import run_webhook
 
 # bot.polling(timeout=40, interval=0, none_stop=False)
 
@@ -14,6 +24,15 @@ apihelper.CONNECT_TIMEOUT = 15
 # updates = bot.get_updates(offset=(bot.last_update_id + 1), timeout=timeout)
 # bot.process_new_updates(updates)
 
+if WEBHOOK_URL:
+    try:
+        run_webhook(bot, WEBHOOK_URL, WEBHOOK_SECRET, port=WEBHOOK_PORT)
+    finally:
+        bot.stop_bot()
+    exit(0)
+
+# Updates can't be polled while webhook is set
+bot.remove_webhook()
 
 while True:
     try:
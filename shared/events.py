@@ -0,0 +1,54 @@
+from datetime import datetime
+
+STREAM = 'lesson-changes'
+DATE_FORMAT = '%Y-%m-%d'
+
+
+class LessonEvents:
+    # Redis stream of lessons changes, written by worker after sync and read by bot processes.
+    # Stream is capped approximately, readers, which are behind by more than maxlen events, must drop their caches
+    def __init__(self, redis, stream=STREAM, maxlen=10000):
+        self.r = redis
+        self.stream = stream
+        self.maxlen = maxlen
+
+    def publish(self, sub_id, group_id, dates, new=0, updated=0, deleted=0):
+        if not dates:
+            return None
+        fields = ['sub', str(sub_id), 'group', str(group_id),
+                  'dates', ','.join(date.strftime(DATE_FORMAT) for date in dates),
+                  'new', new, 'updated', updated, 'deleted', deleted]
+        return self.r.execute_command('XADD', self.stream, 'MAXLEN', '~', self.maxlen, '*', *fields)
+
+    def last_id(self):
+        # Id to start reading from, when previous events don't matter
+        last = self.r.execute_command('XREVRANGE', self.stream, '+', '-', 'COUNT', 1)
+        return _decode(last[0][0]) if last else '0-0'
+
+    def read(self, last_id, count=100, block=None):
+        # Returns [(event id, event)], events are newer than last_id
+        args = ['COUNT', count]
+        if block is not None:
+            args += ['BLOCK', block]
+        response = self.r.execute_command('XREAD', *(args + ['STREAMS', self.stream, last_id]))
+        if not response:
+            return []
+        return [(_decode(event_id), parse_event(fields)) for event_id, fields in response[0][1]]
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def parse_event(fields):
+    # Raw reply is a flat list of names and values, newer clients parse it to dict
+    pairs = fields.items() if isinstance(fields, dict) else zip(fields[::2], fields[1::2])
+    raw = {_decode(name): _decode(value) for name, value in pairs}
+    return {
+        'sub': raw['sub'],
+        'group': int(raw['group']),
+        'dates': [datetime.strptime(date, DATE_FORMAT).date() for date in raw['dates'].split(',') if date],
+        'new': int(raw['new']),
+        'updated': int(raw['updated']),
+        'deleted': int(raw['deleted']),
+    }
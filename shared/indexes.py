@@ -0,0 +1,132 @@
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+
+
+# Every query shape, used by Userdata and Studiesdata, must be covered by one of these indexes
+INDEXES = {
+    'users': [
+        ('uid', [('uid', ASCENDING)]),
+        ('subscription_settings', [('subscription_settings.id', ASCENDING)]),
+    ],
+    'subscriptions': [
+        ('group_id', [('id', ASCENDING)]),
+        ('unused', [('subscribers', ASCENDING), ('unused_since', ASCENDING)]),
+    ],
+    'faculties': [
+        ('faculty_id', [('id', ASCENDING)]),
+        ('faculty_name', [('name', ASCENDING)]),
+    ],
+    'groups': [
+        ('group_id', [('id', ASCENDING)]),
+        ('group_name', [('name', ASCENDING)]),
+        ('group_filter', [('facultie', ASCENDING), ('kind', ASCENDING),
+                          ('type', ASCENDING), ('level', ASCENDING)]),
+    ],
+    'lessons': [
+        ('checksum', [('checksum', ASCENDING)]),
+        ('group_time', [('groups.id', ASCENDING), ('time_start', ASCENDING)]),
+        ('time_start', [('time_start', ASCENDING)]),
+        ('lesson_key', [('key', ASCENDING)]),
+        ('members_time', [('members.sub', ASCENDING), ('time_start', ASCENDING)]),
+    ],
+    'weeks': [
+        ('group_week', [('group', ASCENDING), ('week', ASCENDING)], {'unique': True}),
+    ],
+}
+
+
+# Indexes of previous layouts, they are dropped on startup
+DEPRECATED_INDEXES = {
+    'lessons': ['subscription_time', 'subscriptions_time'],
+}
+
+
+class QueryPlanError(Exception):
+    pass
+
+
+def ensure_collection_indexes(collection, schema=None):
+    # create_index is a no-op for already existed index, so it is safe to run on every startup
+    existed = collection.index_information()
+    for name in DEPRECATED_INDEXES.get(schema or collection.name, []):
+        if name in existed:
+            collection.drop_index(name)
+    return [collection.create_index(keys, name=name, background=True, **(options[0] if options else {}))
+            for name, keys, *options in INDEXES[schema or collection.name]]
+
+
+def ensure_indexes(db):
+    return {name: ensure_collection_indexes(db.get_collection(name)) for name in INDEXES}
+
+
+def _model_queries():
+    now = datetime.now()
+    oid = ObjectId()
+    return [
+        ('users', 'create_or_get_user', {'uid': 0, 'name': ''}),
+        ('users', 'get_user_by_tel_id', {'uid': 0}),
+        ('users', 'set_user_default_group', {'uid': 0, 'subscription_settings.id': oid}),
+        ('users', 'get_notify_chats', {'subscription_settings': {'$elemMatch': {'id': {'$in': [oid]},
+                                                                                 'notify': True}}}),
+        ('subscriptions', 'get_sub_by_group_id', {'id': 0}),
+        ('subscriptions', 'get_subs_ids_by_group_ids', {'id': {'$in': [0]}}),
+        ('subscriptions', 'get_unused_subscriptions', {'subscribers': {'$lte': 0}, 'unused_since': {'$lte': now}}),
+        ('faculties', 'get_facultie_by_facultie_name', {'name': ''}),
+        ('faculties', 'get_facult_by_react_id', {'id': {'$in': [0]}}),
+        ('groups', 'get_group_by_name', {'name': ''}),
+        ('groups', 'get_groups_by', {'facultie': 0, 'kind': 0, 'type': '', 'level': 0}),
+        ('groups', 'get_groups_by(facultie)', {'facultie': 0}),
+        ('lessons', 'check_add_lessons(key)', {'key': {'$in': ['']}}),
+        ('lessons', 'check_add_lessons(slots)', {'groups.id': {'$in': [0]}, 'time_start': {'$in': [now]}}),
+        ('lessons', 'get_lessons_in_day', {'groups.id': 0, '$and': [{'time_start': {'$gte': now}},
+                                                                    {'time_start': {'$lte': now}}]}),
+        ('lessons', 'get_nearest_lesson', {'groups.id': 0, 'time_start': {'$gte': now, '$lt': now}}),
+        ('lessons', 'get_lessons_by_subscription_in_range',
+         {'members.sub': '', '$and': [{'time_start': {'$gte': now - timedelta(days=1)}},
+                                      {'time_start': {'$lte': now}}]}),
+        ('lessons', 'remove_lessons_by_subscriptions', {'members.sub': {'$in': ['']}}),
+        ('lessons', 'get_lessons_starting', {'time_start': {'$gte': now, '$lt': now},
+                                             'members.0': {'$exists': True}}),
+        ('weeks', 'get_weeks_state', {'group': 0, 'week': {'$in': [now]}}),
+        ('weeks', 'remove_weeks_state', {'group': {'$in': [0]}}),
+    ]
+
+
+def _plan_stages(plan):
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, (list, tuple)):
+        for value in plan:
+            yield from _plan_stages(value)
+
+
+def _winning_plans(explain):
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'winningPlan':
+                yield value
+            else:
+                yield from _winning_plans(value)
+    elif isinstance(explain, (list, tuple)):
+        for value in explain:
+            yield from _winning_plans(value)
+
+
+def audit_query_plans(db, raise_on_collscan=True):
+    report = {}
+    for collection, name, query in _model_queries():
+        explain = db.get_collection(collection).find(query).explain()
+        stages = set()
+        for plan in _winning_plans(explain):
+            stages.update(_plan_stages(plan))
+        report['{0}.{1}'.format(collection, name)] = sorted(stages)
+
+    collscans = [name for name, stages in report.items() if 'COLLSCAN' in stages]
+    if collscans and raise_on_collscan:
+        raise QueryPlanError('Queries without index: {0}'.format(', '.join(collscans)))
+    return report
@@ -0,0 +1,39 @@
+from .timeworks import convert_rasp_lessons
+
+
+class _untimed:
+    def __init__(self, stage):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+def sync_weeks(s, group_id, pages, states, sub_id=None, timer=_untimed):
+    # pages - [(week monday, WeekPage or None)] of collect_weeks_pages, states - stored states of these weeks.
+    # Weeks, which are not modified or have the same fingerprint, are skipped, changed ones are reconciled
+    # as one batch. Returns sync counters and converted lessons of changed weeks.
+    # timer - context manager, called with stage name, worker passes stage_timer of its metrics
+    windows = {}
+    changed, unchanged = {}, []
+    for week, page in pages:
+        if page is None:
+            continue
+        if page.not_modified or page.fingerprint == states.get(week, {}).get('fingerprint'):
+            unchanged.append(week)
+            continue
+        with timer('convert'):
+            windows[week] = convert_rasp_lessons(page.days)
+        changed[week] = page.fingerprint, page.etag, page.last_modified
+
+    counters = {}
+    if windows:
+        with timer('sync'):
+            counters = s.sync_lessons(group_id, windows, sub_id=sub_id)
+    counters['skipped_weeks'] = len(unchanged)
+    with timer('update_weeks_state'):
+        s.update_weeks_state(group_id, changed, unchanged)
+    return counters, windows
@@ -1,11 +1,17 @@
 
 from bson.objectid import ObjectId
 
+import os
+import json
 import collections
 import hashlib
-from pymongo import MongoClient
+import threading
+from pymongo import MongoClient, ReturnDocument, InsertOne, ReplaceOne, UpdateOne, UpdateMany, DeleteMany
 from datetime import timedelta, datetime
 
+from .timeworks import week_monday
+from .indexes import ensure_collection_indexes
+
 class Userdata:
     def __init__(self, db):
         self.users = db.get_collection('users')
@@ -25,11 +31,10 @@ class Userdata:
 
     def add_subscription(self, tel_user, message_chat_id, sub_body):
         # sub.update({'notification': True})
-        existed_sub = self.get_sub_by_group_id(sub_body['id'])
-        if not existed_sub:
-            sub = self.subscriptions.insert_one(sub_body).inserted_id
-        else:
-            sub = existed_sub['_id']
+        sub = self.subscriptions.find_one_and_update({'id': int(sub_body['id'])},
+                                                     {'$setOnInsert': dict(sub_body, subscribers=0)},
+                                                     projection={'_id': 1}, upsert=True,
+                                                     return_document=ReturnDocument.AFTER)['_id']
 
         settings = {
             'chat': message_chat_id,
@@ -37,8 +42,10 @@ class Userdata:
             'default': False
         }
         settings.update({'id': sub})
-        self.users.update({'uid': tel_user},
-                          {'$addToSet': {'subscription': sub}})
+        added = self.users.update_one({'uid': tel_user, 'subscription': {'$ne': sub}},
+                                      {'$addToSet': {'subscription': sub}}).modified_count
+        if added:
+            self.subscriptions.update_one({'_id': sub}, {'$inc': {'subscribers': 1}, '$unset': {'unused_since': ''}})
         self.users.update({'uid': tel_user},
                           {'$push': {'subscription_settings': settings}},
                           # {'$set': {'subscription_settings.' + str(sub): settings}},
@@ -54,6 +61,11 @@ class Userdata:
     def get_sub_by_group_id(self, group_id):
         return self.subscriptions.find_one({'id': int(group_id)})
 
+    def get_subs_ids_by_group_ids(self, group_ids):
+        # {group id: subscription id}, groups without subscription are left out
+        raw = self.subscriptions.find({'id': {'$in': [int(group_id) for group_id in group_ids]}}, {'id': 1})
+        return {item['id']: str(item['_id']) for item in raw}
+
     def get_sub_by_string_id(self, sub_id, string_id=False):
         raw = self.subscriptions.find_one({'_id': ObjectId(sub_id)})
         if raw and string_id:
@@ -69,13 +81,25 @@ class Userdata:
         else:
             yield from raw
 
+    def get_subs_by_string_ids(self, sub_ids, string_id=False):
+        raw = self.subscriptions.find({'_id': {'$in': [ObjectId(sub_id) for sub_id in sub_ids]}})
+        for item in raw:
+            if string_id:
+                item.update({'_id': str(item['_id'])})
+            yield item
+
+    def get_all_subs_ids(self):
+        return (item['_id'] for item in self.subscriptions.find({}, {'_id': 1}))
+
     def update_subscription_acces_time(self, sub_id):
         self.subscriptions.update({'_id': ObjectId(sub_id)},
                                   {'$set': {'upd_time': datetime.now()}})
 
     def delete_subscription(self, tel_user, sub_id):
-        self.users.update({'uid': int(tel_user)},
-                          {'$pull': {'subscription': ObjectId(sub_id)}})
+        removed = self.users.update_one({'uid': int(tel_user), 'subscription': ObjectId(sub_id)},
+                                        {'$pull': {'subscription': ObjectId(sub_id)}}).modified_count
+        if removed:
+            self._release_subscription(ObjectId(sub_id))
         self.users.update({'uid': int(tel_user)},
                           {"$pull": {'subscription_settings': {"id": ObjectId(sub_id)}}})
         if self.get_user_default_group(tel_user) == str(sub_id):
@@ -89,6 +113,15 @@ class Userdata:
                 self.unset_default_groups(tel_user)
 
 
+    def _release_subscription(self, sub_id):
+        sub = self.subscriptions.find_one_and_update({'_id': sub_id}, {'$inc': {'subscribers': -1}},
+                                                     projection={'subscribers': 1},
+                                                     return_document=ReturnDocument.AFTER)
+        if sub and sub['subscribers'] <= 0:
+            # Grace period starts here, subscription is removed by unlink_non_used_subs after it
+            self.subscriptions.update_one({'_id': sub_id, 'subscribers': {'$lte': 0}},
+                                          {'$set': {'unused_since': datetime.now()}})
+
     def get_user_subscription_settings(self, tel_user=None, sub_id=None):
         subs = list(self.get_subscriptions(tel_user=tel_user, sub_id=sub_id))
         if not subs:
@@ -171,6 +204,20 @@ class Userdata:
             data.extend(item['subscription'])
         return data
 
+    def get_notify_chats(self, sub_ids):
+        # {subscription id: chats}, only for subscriptions with enabled notifications
+        sub_ids = [ObjectId(sub_id) for sub_id in sub_ids]
+        matched = {'subscription_settings': {'$elemMatch': {'id': {'$in': sub_ids}, 'notify': True}}}
+        chats = collections.defaultdict(set)
+        for item in self.users.aggregate([
+            {'$match': matched},
+            {'$unwind': '$subscription_settings'},
+            {'$match': {'subscription_settings.id': {'$in': sub_ids}, 'subscription_settings.notify': True}},
+            {'$project': {'_id': 0, 'chat': '$subscription_settings.chat', 'id': '$subscription_settings.id'}},
+        ]):
+            chats[str(item['id'])].add(item['chat'])
+        return chats
+
     def get_all_users_subscription_settings(self):
         data = []
         raw = self.users.find({}, {"subscription_settings" :1, '_id':0})
@@ -178,11 +225,38 @@ class Userdata:
             data.extend(item["subscription_settings"])
         return data
 
-    def get_unused_subscriptions(self):
-        return list(self.subscriptions.find({'_id': {"$nin": self.get_all_users_subscribes()}}))
-
-    def delete_unused_subscriptions(self):
-        return self.subscriptions.remove({'_id': {'$in': [i['_id'] for i in self.get_unused_subscriptions()]}})
+    def get_unused_subscriptions(self, grace=timedelta(0)):
+        return (item['_id'] for item in self.subscriptions.find({'subscribers': {'$lte': 0},
+                                                                 'unused_since': {'$lte': datetime.now() - grace}},
+                                                                {'_id': 1}))
+
+    def delete_unused_subscriptions(self, sub_ids):
+        # Subscription could be taken again after it was selected as unused
+        return self.subscriptions.delete_many({'_id': {'$in': list(sub_ids)},
+                                               'subscribers': {'$lte': 0}}).deleted_count
+
+    def recount_subscribers(self):
+        # Builds counters from users subscriptions, for subscriptions created before counters
+        counts = {item['_id']: item['count'] for item in self.users.aggregate([
+            {'$unwind': '$subscription'},
+            {'$group': {'_id': '$subscription', 'count': {'$sum': 1}}},
+        ])}
+        now = datetime.now()
+        requests = []
+        for item in self.subscriptions.find({}, {'_id': 1, 'unused_since': 1}):
+            count = counts.get(item['_id'], 0)
+            update = {'$set': {'subscribers': count}}
+            if count:
+                update['$unset'] = {'unused_since': ''}
+            elif not item.get('unused_since'):
+                update['$set']['unused_since'] = now
+            requests.append(UpdateOne({'_id': item['_id']}, update))
+        if requests:
+            self.subscriptions.bulk_write(requests, ordered=False)
+        return len(requests)
+
+    def has_subscribers_counters(self):
+        return self.subscriptions.find_one({'subscribers': None}, {'_id': 1}) is None
 
     def purge_subscription_timeouts(self):
         return self.subscriptions.update_many({}, {'$set': {'upd_time': datetime.min}})
@@ -222,6 +296,7 @@ class Studiesdata:
         self.faculties = db.get_collection('faculties')
         self.groups = db.get_collection('groups')
         self.lessons = db.get_collection('lessons')
+        self.weeks = db.get_collection('weeks')
 
     def update_faculties(self, data):
         return self.faculties.insert_many(data)
@@ -229,6 +304,45 @@ class Studiesdata:
     def update_groups(self, data):
         return self.groups.insert_many(data)
 
+    def replace_catalog(self, faculties, faculties_groups):
+        # faculties_groups - {faculty id: groups or None}, None means that faculty wasn't fetched,
+        # so its groups are kept as is. Catalog is built aside and swapped in by rename,
+        # so readers never see it partially built
+        existed = {item['id']: item for item in self.groups.find()}
+        groups = []
+        for facult in faculties:
+            fetched = faculties_groups.get(facult['id'])
+            if fetched is None:
+                groups.extend(item for item in existed.values() if item.get('facultie') == facult['id'])
+                continue
+            for gr in fetched:
+                gr['facultie'] = facult['id']
+                groups.append(gr)
+
+        stats = {'faculties': len(faculties), 'groups': len(groups), 'added': 0, 'updated': 0}
+        for gr in groups:
+            old = existed.get(gr['id'])
+            if old is None:
+                stats['added'] += 1
+                continue
+            # Stable _id for known groups
+            gr['_id'] = old['_id']
+            if gr != old:
+                stats['updated'] += 1
+        stats['removed'] = len(existed.keys() - {gr['id'] for gr in groups})
+
+        self._swap_collection('groups', groups)
+        self._swap_collection('faculties', faculties)
+        return stats
+
+    def _swap_collection(self, name, data):
+        staging = self.db.get_collection(name + '_staging')
+        staging.drop()
+        if data:
+            staging.insert_many(data)
+        ensure_collection_indexes(staging, name)
+        staging.rename(name, dropTarget=True)
+
     def get_faculties_names(self):
         faculties = self.faculties.aggregate([{'$project': {'name':1, '_id':0}}])
         return [i['name'] for i in faculties]
@@ -261,52 +375,210 @@ class Studiesdata:
     def add_lessons(self, data):
         return self.lessons.insert_many(data)
 
-    def check_add_lessons(self, data, sub_id=None, checksums_check=True, matches_check=True):
+    def check_add_lessons(self, data, sub_id=None, checksums_check=True, matches_check=True, group_id=None):
+        requests, counters, _, changes = self._plan_lessons(data, group_id, sub_id, checksums_check, matches_check)
+        if requests:
+            self.lessons.bulk_write(requests, ordered=False)
+        counters['dates'] = {group: sorted(dates) for group, dates in changes.items()}
+        return counters
+
+    def sync_lessons(self, group_id, windows, sub_id=None):
+        # windows - {week monday: lessons}, every fetched week of the group is reconciled as a set,
+        # so lessons, removed from upstream, are removed from the collection too
+        data = [item for lessons in windows.values() for item in lessons]
+        requests, counters, kept, changes = self._plan_lessons(data, group_id, sub_id)
+
+        stale = []
+        if windows:
+            weeks = set(windows.keys())
+            # Group could be a member of lesson, which doesn't list it in groups anymore
+            linked = [{'groups.id': group_id}]
+            if sub_id:
+                linked.append({'members.sub': str(sub_id)})
+            existed = self.lessons.find({'$or': linked,
+                                         'time_start': {'$gte': min(weeks), '$lt': max(weeks) + timedelta(days=7)}},
+                                        {'time_start': 1, 'groups.id': 1})
+            for item in existed:
+                if item['_id'] not in kept and week_monday(item['time_start']) in weeks:
+                    stale.append(item['_id'])
+                    changes[group_id].add(item['time_start'].date())
+                    self._mark_changed(changes, item)
+
+        if stale:
+            requests.extend(self._unlink_requests({'_id': {'$in': stale}}, group_id))
+        counters['deleted'] = 0
+        counters['unlinked'] = 0
+        if requests:
+            # One ordered bulk write: stale lessons are unlinked before empty ones are deleted.
+            # Requests are grouped by kind, so it is still sent as one insert, one update and one delete command
+            result = self.lessons.bulk_write(sorted(requests, key=lambda request: _WRITE_ORDER[type(request)]),
+                                             ordered=True)
+            counters['deleted'] = result.deleted_count
+            counters['unlinked'] = len(stale) - result.deleted_count
+        # Days with changed lessons of every group, listed by them: a shared lecture changes schedules of all
+        # groups of the stream. It isn't a counter and must be taken out before summing
+        counters['dates'] = {group: sorted(dates) for group, dates in changes.items()}
+        return counters
+
+    @staticmethod
+    def _unlink_requests(query, group_id):
+        # Lesson is shared by groups of a stream, it is removed only when no group or no member is left.
+        # Checksum of left groups doesn't match the stored lesson anymore, so it is reset: the next sync,
+        # which lists the lesson, replaces it instead of counting it as the same
+        return [UpdateMany(query, {'$pull': {'groups': {'id': group_id}, 'members': {'group': group_id}},
+                                   '$set': {'checksum': UNLINKED_CHECKSUM}}),
+                DeleteMany({'$and': [query, {'$or': [{'groups': {'$size': 0}}, {'members': {'$size': 0}}]}]})]
+
+    def _plan_lessons(self, data, group_id=None, sub_id=None, checksums_check=True, matches_check=True):
+        now = datetime.now()
+        member = {'group': group_id, 'sub': str(sub_id)} if group_id is not None and sub_id else None
+        batch = collections.OrderedDict()
+        for item, (key, checksum) in zip(data, fingerprint_lessons(data)):
+            item['key'] = key
+            item['checksum'] = checksum
+            item['upd_time'] = now
+            item['members'] = [member] if member else []
+            # Same lesson may come twice, when fetched weeks are overlapping
+            batch.setdefault(item['key'], item)
+
+        existed_keys = {}
+        if checksums_check and batch:
+            existed = self.lessons.find({'key': {'$in': list(batch.keys())}},
+                                        {'key': 1, 'checksum': 1, 'members': 1, 'groups.id': 1})
+            existed_keys = {item['key']: item for item in existed}
+
+        requests = []
+        kept = set()
+        changes = collections.defaultdict(set)
         counter_same = 0
         counter_update = 0
-
-        checksum_cleared_data= []
-        for item in data:
-            checksum = sha256(gen_checkstring(item))
-            item['checksum'] = checksum
-            item['upd_time'] = datetime.now()
-            if sub_id:
-                item['sub_id'] = sub_id
-
-            if checksums_check:
-                existed = self.lessons.find_one({'checksum': checksum})
-                if existed:
-                    counter_same += 1
-                    self.lessons.update({'_id': existed['_id']}, {'$set': {'upd_time': datetime.now()}})
-                    continue
-                else:
-                    checksum_cleared_data.append(item)
+        key_cleared_data = []
+        for key, item in batch.items():
+            existed = existed_keys.get(key)
+            if existed is None:
+                key_cleared_data.append(item)
+            elif existed['checksum'] == item['checksum']:
+                counter_same += 1
+                kept.add(existed['_id'])
+                update = {'$set': {'upd_time': now}}
+                if member:
+                    update['$addToSet'] = {'members': member}
+                requests.append(UpdateOne({'_id': existed['_id']}, update))
             else:
-                checksum_cleared_data.append(item)
-
-        clear_data = []
-        for item in checksum_cleared_data:
-            if matches_check:
-                existed = self.lessons.find_one({
-                    "time_start": item["time_start"],
-                   "time_end": item["time_end"],
-                   "groups.id": {'$in' :[gr['id'] for gr in item["groups"]]},
-                   "weekday": item["weekday"]
-                })
-
-                if existed:
-                    self.lessons.update({'_id': existed['_id']}, item)
-                    counter_update += 1
-                    data.remove(item)
-                else:
-                    clear_data.append(item)
-            else:
-                clear_data.append(item)
+                # The same lesson, but list of groups of the stream has changed
+                counter_update += 1
+                kept.add(existed['_id'])
+                self._mark_changed(changes, item, existed)
+                requests.append(ReplaceOne({'_id': existed['_id']}, self._merge_members(item, existed)))
+
+        matches = {}
+        if matches_check and key_cleared_data:
+            matches = self._find_lessons_slots(key_cleared_data)
 
         inserted = 0
-        if clear_data:
-            inserted = len(self.add_lessons(data).inserted_ids)
-        return {'new': inserted, 'same': counter_same, 'updated': counter_update}
+        for item in key_cleared_data:
+            existed = self._pop_lesson_slot(matches, item)
+            if existed and existed['_id'] not in kept:
+                counter_update += 1
+                kept.add(existed['_id'])
+                self._mark_changed(changes, item, existed)
+                requests.append(ReplaceOne({'_id': existed['_id']}, self._merge_members(item, existed)))
+            else:
+                inserted += 1
+                self._mark_changed(changes, item)
+                requests.append(InsertOne(item))
+
+        return requests, {'new': inserted, 'same': counter_same, 'updated': counter_update}, kept, changes
+
+    @staticmethod
+    def _mark_changed(changes, item, existed=None):
+        # Groups, which have left the replaced lesson, see the change too
+        groups = {gr['id'] for gr in item.get('groups', [])}
+        if existed:
+            groups.update(gr['id'] for gr in existed.get('groups', []))
+        for group in groups:
+            changes[group].add(item['time_start'].date())
+
+    @staticmethod
+    def _merge_members(item, existed):
+        # Members of groups, which have left the lesson, are dropped with them
+        groups = {gr['id'] for gr in item['groups']}
+        members = [member for member in existed.get('members', []) if member['group'] in groups]
+        members.extend(member for member in item['members'] if member not in members)
+        item['members'] = members
+        return item
+
+    def _find_lessons_slots(self, data):
+        # Prefetch every lesson, which can occupy the same time slot for any of requested groups
+        groups = {gr['id'] for item in data for gr in item['groups']}
+        starts = {item['time_start'] for item in data}
+        existed = self.lessons.find({'groups.id': {'$in': list(groups)},
+                                     'time_start': {'$in': list(starts)}},
+                                    {'time_start': 1, 'time_end': 1, 'weekday': 1, 'groups.id': 1, 'members': 1})
+        slots = collections.defaultdict(list)
+        for item in existed:
+            key = item['time_start'], item.get('time_end'), item.get('weekday')
+            slots[key].append((item, {gr['id'] for gr in item.get('groups', [])}))
+        return slots
+
+    @staticmethod
+    def _pop_lesson_slot(slots, item):
+        candidates = slots.get((item['time_start'], item['time_end'], item['weekday']), [])
+        groups = {gr['id'] for gr in item['groups']}
+        for index, (existed, slot_groups) in enumerate(candidates):
+            if groups & slot_groups:
+                # Each stored lesson can be replaced only once per batch
+                del candidates[index]
+                return existed
+        return None
+
+    def migrate_lessons(self, batch_size=1000):
+        # Lessons, stored before membership of groups, have list of subscriptions ids (or single sub_id)
+        # and no stable key, and ones with sha256 of gen_checkstring have fingerprints of previous format
+        query = {'$or': [{'key': None}, {'checksum': {'$regex': LEGACY_CHECKSUM}}, {'members': None}]}
+        groups = None
+        migrated = 0
+        requests = []
+        for item in self.lessons.find(query):
+            key, checksum = lesson_fingerprint(item)
+            update = {'$set': {'key': key, 'checksum': checksum}}
+            if 'members' not in item:
+                if groups is None:
+                    groups = {str(sub['_id']): sub['id'] for sub in self.db.subscriptions.find({}, {'id': 1})}
+                subs = item.get('subs', [item['sub_id']] if item.get('sub_id') else [])
+                update['$set']['members'] = [{'group': groups[str(sub)], 'sub': str(sub)}
+                                             for sub in subs if str(sub) in groups]
+                update['$unset'] = {'subs': '', 'sub_id': ''}
+            requests.append(UpdateOne({'_id': item['_id']}, update))
+            if len(requests) >= batch_size:
+                migrated += self.lessons.bulk_write(requests, ordered=False).modified_count
+                requests = []
+        if requests:
+            migrated += self.lessons.bulk_write(requests, ordered=False).modified_count
+        return migrated
+
+    def get_weeks_state(self, group_id, weeks):
+        raw = self.weeks.find({'group': group_id, 'week': {'$in': list(weeks)}})
+        return {item['week']: item for item in raw}
+
+    def update_weeks_state(self, group_id, changed, unchanged):
+        # changed - {week: (fingerprint, etag, last_modified)}, unchanged weeks only become fresher
+        now = datetime.now()
+        requests = [UpdateOne({'group': group_id, 'week': week},
+                              {'$set': {'fingerprint': fingerprint, 'etag': etag, 'last_modified': last_modified,
+                                        'upd_time': now, 'checked_time': now}},
+                              upsert=True)
+                    for week, (fingerprint, etag, last_modified) in changed.items()]
+        if unchanged:
+            requests.append(UpdateMany({'group': group_id, 'week': {'$in': list(unchanged)}},
+                                       {'$set': {'checked_time': now}}))
+        if requests:
+            self.weeks.bulk_write(requests, ordered=False)
+
+    def remove_weeks_state(self, group_ids):
+        if not group_ids:
+            return 0
+        return self.weeks.delete_many({'group': {'$in': list(group_ids)}}).deleted_count
 
     def get_lessons_in_day(self, group_id:int, day: datetime):
         return list(self.lessons.find({'groups.id':group_id,
@@ -321,7 +593,7 @@ class Studiesdata:
                                  {'checksum': 0, '_id':0},)
 
     def get_lessons_by_subscription_by_delta(self, sub_id, date, delta):
-        q = {"sub_id": str(sub_id)}
+        q = {"members.sub": str(sub_id)}
         q.update({'$and':
                      [{"time_start": {'$gte': date - delta}},
                       {"time_start": {'$lte': date + delta}}]
@@ -330,7 +602,7 @@ class Studiesdata:
         return list(self.lessons.find(q))
 
     def get_lessons_by_subscription_in_range(self, sub_id, from_, to):
-        q = {"sub_id": str(sub_id)}
+        q = {"members.sub": str(sub_id)}
         q.update({'$and':
                      [{"time_start": {'$gte': from_}},
                       {"time_start": {'$lte': to}}]
@@ -338,30 +610,76 @@ class Studiesdata:
                  )
         return list(self.lessons.find(q))
 
+    def get_lessons_starting(self, from_, to, projection=None):
+        return self.lessons.find({'time_start': {'$gte': from_, '$lt': to}, 'members.0': {'$exists': True}},
+                                 projection)
+
+    def get_lessons_by_ids(self, lesson_ids):
+        return list(self.lessons.find({'_id': {'$in': [ObjectId(lesson_id) for lesson_id in lesson_ids]}}))
+
     def remove_lessons_by_subscriptions(self, sub_ids:list):
-        return self.lessons.remove({'sub_id': {'$in': [str(sub_id) for sub_id in sub_ids]}})
-
-def gen_checkstring(dict_: dict) -> str:
-    dict_ = collections.OrderedDict(sorted(dict_.items()))
-    checkstr = ''
-    for v in dict_.values():
-        if isinstance(v, (list,tuple)):
-            for subv in v:
-                if isinstance(subv, dict):
-                    checkstr += gen_checkstring(subv)
-        elif isinstance(v, dict):
-            checkstr += gen_checkstring(v)
-        elif isinstance(v, int):
-            checkstr += str(v)
-        elif isinstance(v, datetime):
-            checkstr += v.strftime('%Y%m%d%H%M%S')
-        elif isinstance(v, str):
-            checkstr += v
-    return checkstr
-
-def sha256(w):
-    h = hashlib.sha256(w.encode('utf-8'))
-    return h.hexdigest()
+        sub_ids = [str(sub_id) for sub_id in sub_ids]
+        linked = [item['_id'] for item in self.lessons.find({'members.sub': {'$in': sub_ids}}, {'_id': 1})]
+        if not linked:
+            return 0
+        self.lessons.update_many({'_id': {'$in': linked}}, {'$pull': {'members': {'sub': {'$in': sub_ids}}}})
+        return self.lessons.delete_many({'_id': {'$in': linked}, 'members': {'$size': 0}}).deleted_count
+
+# Order of requests kinds in one bulk write of sync_lessons
+_WRITE_ORDER = {InsertOne: 0, UpdateOne: 1, ReplaceOne: 1, UpdateMany: 1, DeleteMany: 2}
+# Fields, set by storage, they aren't part of lesson content
+LESSON_META_FIELDS = frozenset(('_id', 'key', 'checksum', 'upd_time', 'sub_id', 'subs', 'members'))
+# Fields, which don't make identity of lesson: lecture of a stream of groups is stored once
+LESSON_SHARED_FIELDS = frozenset(('groups',))
+FINGERPRINT_SIZE = 20
+LEGACY_CHECKSUM = '^[0-9a-f]{64}$'
+# Never equal to a fingerprint
+UNLINKED_CHECKSUM = ''
+
+def _canonical_default(value):
+    if isinstance(value, datetime):
+        return {'$date': value.isoformat()}
+    return str(value)
+
+# Canonical form of lesson: sorted keys and no whitespaces. Unlike gen_checkstring it keeps types
+# (None, bools, floats) and boundaries of strings, so any change of content changes the fingerprint.
+_canonical = json.JSONEncoder(sort_keys=True, ensure_ascii=False, separators=(',', ':'),
+                              default=_canonical_default).encode
+
+def lesson_fingerprint(lesson: dict):
+    # Returns (key, checksum): key is the stable identity of lesson, checksum covers whole content.
+    # Checksum continues hashing of the key, so content is serialized and hashed only once.
+    content = {k: v for k, v in lesson.items() if k not in LESSON_META_FIELDS and k not in LESSON_SHARED_FIELDS}
+    shared = {k: v for k, v in lesson.items() if k in LESSON_SHARED_FIELDS}
+    key = hashlib.blake2b(_canonical(content).encode('utf-8'), digest_size=FINGERPRINT_SIZE)
+    checksum = key.copy()
+    checksum.update(_canonical(shared).encode('utf-8'))
+    return key.hexdigest(), checksum.hexdigest()
+
+def fingerprint_lessons(lessons):
+    return [lesson_fingerprint(lesson) for lesson in lessons]
+
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+def get_client(connection):
+    # MongoClient isn't fork-safe, so clients are created lazily and only shared inside one process
+    global _clients_pid
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+        if connection not in _clients:
+            _clients[connection] = MongoClient(connection, connect=False)
+        return _clients[connection]
+
+def reset_clients():
+    # Called in forked child: inherited sockets belong to parent, so clients are dropped without closing
+    global _clients_pid
+    with _clients_lock:
+        _clients.clear()
+        _clients_pid = None
 
 def context_model(model, connection, db):
     class context_model:
@@ -369,7 +687,7 @@ def context_model(model, connection, db):
             self._kwargs = kwargs
 
         def __enter__(self):
-            self.conn = MongoClient(connection)
+            self.conn = get_client(connection)
             if hasattr(self._kwargs, 'purge_schema') and self._kwargs['purge_schema']:
                 for collection in self._kwargs['purge_schema']:
                     self.conn.drop_database(collection)
@@ -377,7 +695,7 @@ def context_model(model, connection, db):
             return self.model
 
         def __exit__(self, exc_type, exc_val, exc_tb):
+            # Connection stays in the process-wide pool
             del self.model
-            self.conn.close()
 
     return context_model
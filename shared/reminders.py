@@ -0,0 +1,62 @@
+import time
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+
+# Takes due reminders and removes them at once, so every reminder is sent by one tick only
+_POP_DUE = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, member in ipairs(due) do
+    redis.call('ZREM', KEYS[1], member)
+end
+return due
+"""
+
+
+class ReminderQueue:
+    # Time ordered queue of upcoming reminders: member is "chat:subscription:lesson", score is time to send it
+    key = 'reminders'
+
+    def __init__(self, redis, lead=15 * MINUTE, horizon=2 * HOUR):
+        self.r = redis
+        self.lead = lead
+        self.horizon = horizon
+        self._pop_due = redis.register_script(_POP_DUE)
+
+    @staticmethod
+    def member(chat_id, sub_id, lesson_id):
+        return '{0}:{1}:{2}'.format(chat_id, sub_id, lesson_id)
+
+    @staticmethod
+    def parse(member):
+        if isinstance(member, bytes):
+            member = member.decode('utf-8')
+        chat_id, sub_id, lesson_id = member.split(':')
+        return int(chat_id), sub_id, lesson_id
+
+    def plan(self, reminders, now=None):
+        # reminders - (chat, subscription, lesson, lesson start timestamp) for lessons inside the horizon.
+        # Planned reminders, which are no more expected (lesson is moved or notifications are off), are dropped
+        now = now or time.time()
+        expected = {}
+        for chat_id, sub_id, lesson_id, start in reminders:
+            due = start - self.lead
+            if due > now:
+                expected[self.member(chat_id, sub_id, lesson_id)] = due
+        planned = {member.decode('utf-8') for member in
+                   self.r.zrangebyscore(self.key, '({0}'.format(now), now + self.horizon - self.lead)}
+        stale = planned - set(expected)
+        pipe = self.r.pipeline(transaction=False)
+        if stale:
+            pipe.zrem(self.key, *stale)
+        if expected:
+            pipe.zadd(self.key, **expected)
+        pipe.execute()
+        return {'planned': len(expected), 'dropped': len(stale)}
+
+    def pop_due(self, limit=500, now=None):
+        due = self._pop_due(keys=[self.key], args=[now or time.time(), limit])
+        return [self.parse(member) for member in due]
+
+    def pending(self):
+        return self.r.zcard(self.key)
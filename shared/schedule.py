@@ -0,0 +1,107 @@
+import random
+import time
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+# Claims due subscriptions atomically: claimed ones are moved forward by lease time,
+# so several ticks never take the same subscription, and crashed refresh is retried after lease
+_POP_DUE = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, member in ipairs(due) do
+    redis.call('ZADD', KEYS[1], ARGV[3], member)
+end
+return due
+"""
+
+# Sets due time only if it makes refresh earlier
+_ADVANCE = """
+local current = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if (not current) or tonumber(current) > tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+class RefreshSchedule:
+    due_key = 'refresh-due'
+    activity_key = 'refresh-activity'
+    changed_key = 'refresh-changed'
+
+    def __init__(self, redis, min_interval=30 * MINUTE, max_interval=12 * HOUR,
+                 active_window=DAY, jitter=0.2, lease=15 * MINUTE):
+        self.r = redis
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.active_window = active_window
+        self.jitter = jitter
+        self.lease = lease
+        self._pop_due = redis.register_script(_POP_DUE)
+        self._advance = redis.register_script(_ADVANCE)
+
+    def _jittered(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def interval(self, last_active=None, last_changed=None, now=None):
+        now = now or time.time()
+        recent = max(last_active or 0, last_changed or 0)
+        idle = now - recent
+        if idle <= self.active_window:
+            return self.min_interval
+        # Every idle day doubles refresh interval for dormant subscriptions
+        return min(self.max_interval, self.min_interval * 2 ** int(idle // self.active_window))
+
+    def touch(self, sub_ids, now=None):
+        # User activity: remember it and pull next refresh to the nearest active interval
+        now = now or time.time()
+        pipe = self.r.pipeline(transaction=False)
+        for sub_id in sub_ids:
+            pipe.zadd(self.activity_key, **{str(sub_id): now})
+            self._advance(keys=[self.due_key], args=[str(sub_id), now + self._jittered(self.min_interval)],
+                          client=pipe)
+        pipe.execute()
+
+    def is_active(self, sub_id, now=None):
+        last_active = self.r.zscore(self.activity_key, str(sub_id))
+        return last_active is not None and (now or time.time()) - last_active <= self.active_window
+
+    def mark_changed(self, sub_id, now=None):
+        self.r.zadd(self.changed_key, **{str(sub_id): now or time.time()})
+
+    def schedule(self, sub_id, now=None):
+        now = now or time.time()
+        sub_id = str(sub_id)
+        interval = self.interval(self.r.zscore(self.activity_key, sub_id),
+                                 self.r.zscore(self.changed_key, sub_id), now)
+        due = now + self._jittered(interval)
+        self.r.zadd(self.due_key, **{sub_id: due})
+        return due
+
+    def add(self, sub_ids, now=None):
+        # New entries are spread over the shortest interval, to avoid a spike of refreshes
+        now = now or time.time()
+        added = 0
+        for sub_id in sub_ids:
+            added += self.r.execute_command('ZADD', self.due_key, 'NX',
+                                            now + random.uniform(0, self.min_interval), str(sub_id))
+        return added
+
+    def pop_due(self, limit=100, now=None):
+        now = now or time.time()
+        due = self._pop_due(keys=[self.due_key], args=[now, limit, now + self.lease])
+        return [sub_id.decode('utf-8') if isinstance(sub_id, bytes) else sub_id for sub_id in due]
+
+    def remove(self, sub_ids):
+        sub_ids = [str(sub_id) for sub_id in sub_ids]
+        if not sub_ids:
+            return
+        pipe = self.r.pipeline()
+        for key in (self.due_key, self.activity_key, self.changed_key):
+            pipe.zrem(key, *sub_ids)
+        pipe.execute()
+
+    def scheduled(self):
+        return [sub_id.decode('utf-8') for sub_id in self.r.zrange(self.due_key, 0, -1)]
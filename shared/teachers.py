@@ -0,0 +1,55 @@
+import json
+
+SEARCH = 'search'
+SCHEDULE = 'schedule'
+
+
+def normalize_query(query):
+    return ' '.join(str(query).lower().replace('ё', 'е').split())
+
+
+class TeacherCache:
+    # Scraped teacher search results and schedules, shared by bot and worker
+    ttl = {SEARCH: 60 * 60 * 24, SCHEDULE: 60 * 60}
+    inflight_ttl = 30
+    # Finished tasks publish results here, so bot doesn't wait for them in handlers
+    replies_channel = 'teacher-replies'
+
+    def __init__(self, redis, ttl=None):
+        self.r = redis
+        self.ttl = dict(self.ttl, **(ttl or {}))
+
+    @staticmethod
+    def _key(kind, arg):
+        return 'teacher-{0}-{1}'.format(kind, normalize_query(arg))
+
+    def reply_key(self, kind, arg):
+        return self._key(kind, arg)
+
+    def lookup(self, kind, arg):
+        raw = self.r.get(self._key(kind, arg))
+        if raw is None:
+            return False, None
+        return True, json.loads(raw.decode('utf-8'))
+
+    def store(self, kind, arg, value):
+        return self.r.set(self._key(kind, arg), json.dumps(value), ex=self.ttl[kind])
+
+    def claim(self, kind, arg, task_id):
+        # Single flight: returns id of already running identical task, or None if given task now owns the key
+        key = self._key(kind, arg) + '-inflight'
+        if self.r.set(key, task_id, nx=True, ex=self.inflight_ttl):
+            return None
+        running = self.r.get(key)
+        return running.decode('utf-8') if running else None
+
+    def release(self, kind, arg):
+        return self.r.delete(self._key(kind, arg) + '-inflight')
+
+    def publish(self, kind, arg, value):
+        return self.r.publish(self.replies_channel, json.dumps({'key': self._key(kind, arg), 'value': value}))
+
+    @staticmethod
+    def parse_reply(raw):
+        reply = json.loads(raw.decode('utf-8') if isinstance(raw, bytes) else raw)
+        return reply['key'], reply['value']
@@ -10,7 +10,7 @@ def timeout_has_passed(sub, renew_time):
             date = datetime.strptime(date, "%Y-%m-%dT%H:%M:%S.%f")
         except ValueError:
             date = datetime.strptime(date, "%Y-%m-%dT%H:%M:%S")
-    return (datetime.now() - date).seconds > renew_time
+    return (datetime.now() - date).total_seconds() > renew_time
 
 def next_weekday(date, weekday):
     day_gap = weekday - date.weekday()
@@ -60,6 +60,9 @@ def get_weeks_range(depth):
     weeks.extend(get_mondays_ahead(depth))
     return sorted(weeks)
 
+def week_monday(date):
+    return datetime(date.year, date.month, date.day) - timedelta(days=date.weekday())
+
 def strf_list(datetime_list):
     return [dat.strftime('%Y-%m-%d') for dat in datetime_list]
 
@@ -70,6 +73,21 @@ def convert_concat_day_and_lesson(lesson: str, weekday: datetime) -> datetime:
                  day=weekday.day)
     return lesson
 
+def convert_rasp_lessons(current_rasp):
+    for rasp in current_rasp:
+        if rasp == []:
+            continue
+        weekday = datetime.strptime(rasp['date'], '%Y-%m-%d')
+        for lesson in rasp['lessons']:
+            lesson['time_start'] = convert_concat_day_and_lesson(lesson['time_start'], weekday)
+            lesson['time_end'] = convert_concat_day_and_lesson(lesson['time_end'], weekday)
+            lesson['weekday'] = rasp['weekday']
+    # use only lessons, without weeks info
+    lessons = []
+    for lesson in [rasp['lessons'] for rasp in current_rasp if rasp != []]:
+        lessons.extend(lesson)
+    return lessons
+
 def full_week(date):
     year, week, dow = date.isocalendar()
     if dow == 1:
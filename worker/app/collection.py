@@ -1,11 +1,95 @@
-
+import os
 import re
 import json
+import time
+import random
+import hashlib
 import requests
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from lxml import etree
 
+try:
+    from ujson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 TIMEOUT = 5
+RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 16))
+
+# Request priorities: interactive requests are made for user, who waits for answer
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+_session = None
+_session_pid = None
+_rate_limiter = None
+_metrics = None
+
+def set_rate_limiter(limiter):
+    # limiter must have acquire(lane) method, requests aren't limited without it
+    global _rate_limiter
+    _rate_limiter = limiter
+
+def set_metrics(metrics):
+    # metrics must have fetched(lane, status, seconds), retried(lane, reason) and parsed(method, seconds) methods
+    global _metrics
+    _metrics = metrics
+
+def _observe(event, *args):
+    if _metrics is not None:
+        getattr(_metrics, event)(*args)
+
+def get_session():
+    # One keep-alive session per process, sockets can't be shared with forked workers
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        session = requests.Session()
+        # Connection-level retries only, application-level ones are made in fetch_page
+        retry = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+        _session, _session_pid = session, os.getpid()
+    return _session
+
+def backoff_delay(attempt):
+    # Exponential backoff with "full jitter"
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+INITIAL_STATE_MARKER = b'window.__INITIAL_STATE__ ='
+SCRIPT_END = b'</script>'
+
+def extract_initial_state(content):
+    # Finds the state literal right in the raw page bytes, without building the whole DOM
+    start = content.find(INITIAL_STATE_MARKER)
+    if start < 0:
+        return None
+    start += len(INITIAL_STATE_MARKER)
+    end = content.find(SCRIPT_END, start)
+    if end < 0:
+        return None
+    # Literal ends with the last semicolon of the script, surrounding whitespaces are allowed by decoder
+    semicolon = content.rfind(b';', start, end)
+    literal = content[start:semicolon if semicolon > 0 else end]
+    try:
+        return json_loads(literal)
+    except ValueError:
+        pass
+    try:
+        # Script contains something after the literal, let decoder find where the literal ends,
+        # it doesn't skip leading whitespaces
+        return json.JSONDecoder().raw_decode(literal.decode('utf-8').lstrip())[0]
+    except ValueError:
+        # Caller falls back to DOM search
+        return None
 
 def parse_react_init(element):
     if element is None:
@@ -16,52 +100,117 @@ def parse_react_init(element):
     data = json.loads(m.groups()[0])
     return data
 
-def collect_element_from_page(page, xpath, params=None, retries=5):
-    while retries > 0:
+def find_element(text, xpath):
+    data = etree.HTML(text).xpath(xpath)
+    if len(data) > 0:
+        return data[0]
+    return None
+
+def fetch_page(page, parse, params=None, retries=RETRIES, headers=None, lane=BULK):
+    for attempt in range(retries):
+        if attempt > 0:
+            time.sleep(backoff_delay(attempt))
+        if _rate_limiter is not None and not _rate_limiter.acquire(lane):
+            print('Rate limit wait exceeded for {0}'.format(page))
+            _observe('retried', lane, 'rate_limit')
+            continue
+        start = time.perf_counter()
         try:
-            response = requests.get(page, params=params, timeout=TIMEOUT)
-        except requests.Timeout:
-            print('Request timeout for {0}'.format(page))
-            retries -= 1
-            # return None
-        else:
-            if not response.ok:
-                return None
-            page = etree.HTML(response.text)
-            data = page.xpath(xpath)
-            if len(data) > 0:
-                return data[0]
+            response = get_session().get(page, params=params, timeout=TIMEOUT, headers=headers)
+        except requests.RequestException as e:
+            print('Request to {0} failed: {1}'.format(page, e))
+            _observe('fetched', lane, 'error', time.perf_counter() - start)
+            _observe('retried', lane, 'error')
+            continue
+        _observe('fetched', lane, response.status_code, time.perf_counter() - start)
+        if response.status_code >= 500:
+            print('Server error {0} for {1}'.format(response.status_code, page))
+            _observe('retried', lane, 'server_error')
+            continue
+        if not response.ok:
+            return None
+        data = parse(response)
+        if data is not None:
+            return data
+        print('Nothing to parse on {0}'.format(page))
+        _observe('retried', lane, 'parse')
     return None
 
-def collect_json(page, xpath, params=None, retries=5):
-    element = collect_element_from_page(page, xpath, params, retries)
-    data = parse_react_init(element)
+def parse_page_state(response, xpath):
+    start = time.perf_counter()
+    data = extract_initial_state(response.content)
+    if data is not None:
+        _observe('parsed', 'fast', time.perf_counter() - start)
+        return data
+    # Page layout has changed, fallback to DOM search
+    start = time.perf_counter()
+    data = parse_react_init(find_element(response.text, xpath))
+    _observe('parsed', 'dom', time.perf_counter() - start)
     return data
 
-def collect_faculties():
-    data = collect_json('http://ruz.spbstu.ru/', '/html/body/script[1]')
+def collect_json(page, xpath, params=None, retries=RETRIES, lane=BULK):
+    return fetch_page(page, lambda response: parse_page_state(response, xpath), params, retries, lane=lane)
+
+def collect_faculties(lane=BULK):
+    data = collect_json('http://ruz.spbstu.ru/', '/html/body/script[1]', lane=lane)
     if data:
         return data['faculties']['data']
 
-def collect_groups(faculty_id):
-    data = collect_json('http://ruz.spbstu.ru/faculty/{0}/groups'.format(faculty_id), '/html/body/script[1]')
+def collect_groups(faculty_id, lane=BULK):
+    data = collect_json('http://ruz.spbstu.ru/faculty/{0}/groups'.format(faculty_id), '/html/body/script[1]',
+                        lane=lane)
     if data:
         return data['groups']['data'][str(faculty_id)]
 
-def collect_rasp(faculty_id, group_id, params=None):
-    data = collect_json('http://ruz.spbstu.ru/faculty/{0}/groups/{1}'.format(faculty_id, group_id),
-                                        '/html/body/script[1]', params=params)
-    # pprint(data)
-    if data:
-        return data['lessons']['data'][str(group_id)]
+WeekPage = namedtuple('WeekPage', ['days', 'fingerprint', 'etag', 'last_modified', 'not_modified'])
+
+def week_fingerprint(days):
+    raw = json.dumps(days, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def conditional_headers(validators):
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+def parse_week_page(response, group_id):
+    etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+    if response.status_code == 304:
+        return WeekPage(None, None, etag, last_modified, True)
+    data = parse_page_state(response, '/html/body/script[1]')
+    if data is None:
+        return None
+    days = data['lessons']['data'][str(group_id)]
+    return WeekPage(days, week_fingerprint(days), etag, last_modified, False)
+
+def collect_rasp_week(faculty_id, group_id, week=None, validators=None, lane=BULK):
+    # validators - ETag and Last-Modified of previously fetched page, used for conditional request
+    return fetch_page('http://ruz.spbstu.ru/faculty/{0}/groups/{1}'.format(faculty_id, group_id),
+                      lambda response: parse_week_page(response, group_id),
+                      params={'date': week} if week != None else {},
+                      headers=conditional_headers(validators), lane=lane)
+
+def collect_weeks_pages(faculty_id, group_id, weeks, states, concurrency=1, lane=BULK):
+    # Returns [(week, WeekPage or None)] in order of weeks, states - {week: validators of stored page}
+    def collect_week(week):
+        return week, collect_rasp_week(faculty_id, group_id, week.strftime('%Y-%m-%d'), states.get(week), lane=lane)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(weeks)))) as pool:
+        return list(pool.map(collect_week, weeks))
 
-def get_teachers(query):
-    data = collect_json('http://ruz.spbstu.ru/search/teacher?', '/html/body/script[1]', params={'q': query})
+def get_teachers(query, lane=INTERACTIVE):
+    data = collect_json('http://ruz.spbstu.ru/search/teacher?', '/html/body/script[1]', params={'q': query},
+                        lane=lane)
     if data:
         return data['searchTeacher']['data']
 
-def get_teacher_rasp(teacher_id, params=None):
+def get_teacher_rasp(teacher_id, params=None, lane=INTERACTIVE):
     teacher_id = str(teacher_id)
-    data = collect_json('http://ruz.spbstu.ru/teachers/' + teacher_id, '/html/body/script[1]', params=params)
+    data = collect_json('http://ruz.spbstu.ru/teachers/' + teacher_id, '/html/body/script[1]', params=params,
+                        lane=lane)
     if data:
         return data['teacherSchedule']['data'][teacher_id]
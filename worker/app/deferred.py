@@ -1,14 +1,33 @@
 import os
+import json
+import time
+import collections
 from celery import Celery, group
 from celery.schedules import crontab
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown, task_prerun, task_postrun
+from pymongo import MongoClient
+from redis import Redis
+from redis.exceptions import RedisError
 from datetime import datetime, timedelta
 import locale
+from concurrent.futures import ThreadPoolExecutor
 
 
-from .shared.model import context_model
+from .shared.model import context_model, reset_clients
 from .shared.model import Studiesdata, Userdata
-from .shared.timeworks import timeout_has_passed, get_weeks_range, convert_concat_day_and_lesson, strf_list
-from .collection import collect_groups, collect_faculties, collect_rasp, get_teachers, get_teacher_rasp
+from .shared.schedule import RefreshSchedule
+from .shared.teachers import TeacherCache, SEARCH, SCHEDULE
+from .shared.reminders import ReminderQueue
+from .shared.events import LessonEvents
+from .shared.ingest import sync_weeks
+from .shared.indexes import ensure_indexes, audit_query_plans as audit_plans
+from .shared.timeworks import timeout_has_passed, get_weeks_range, week_monday
+from .collection import collect_groups, collect_faculties, collect_weeks_pages, get_teachers, \
+    get_teacher_rasp, set_rate_limiter, set_metrics, INTERACTIVE, BULK
+from .ratelimit import TokenBucket
+from .metrics import FetchMetrics, stage_timer, observe_sync, observe_week, observe_task, \
+    reset_metrics_dir, start_metrics_server, process_dead
+from .telegram import send_message, format_reminder
 
 locale.setlocale(locale.LC_ALL, ('RU','UTF8'))
 
@@ -16,11 +35,25 @@ CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379'
 CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND', 'redis://localhost:6379')
 MONGO_CONNECTION = os.environ.get('MONGO_CONNECTION', 'mongodb://localhost:27017/')
 MONGO_DB = os.environ.get('MONGO_DB', 'raspisator')
+REDIS_CACHE = os.environ.get('REDIS_CACHE', 'redis://localhost:6379/2')
 
 
 UserStandalone = context_model(Userdata, MONGO_CONNECTION, MONGO_DB)
 StudiesStandalone = context_model(Studiesdata, MONGO_CONNECTION, MONGO_DB)
 
+redis = Redis.from_url(REDIS_CACHE)
+schedule = RefreshSchedule(redis)
+teachers = TeacherCache(redis)
+events = LessonEvents(redis)
+reminders = ReminderQueue(redis, lead=60 * int(os.environ.get('REMINDER_LEAD_MINUTES', 15)))
+
+# All requests to ruz.spbstu.ru from all workers share one rate limit
+set_rate_limiter(TokenBucket(redis,
+                             rate=float(os.environ.get('RUZ_RATE', 5)),
+                             burst=int(os.environ.get('RUZ_BURST', 10)),
+                             interactive_reserve=int(os.environ.get('RUZ_INTERACTIVE_RESERVE', 3))))
+set_metrics(FetchMetrics())
+
 
 app = Celery(broker=CELERY_BROKER_URL,
              backend=CELERY_RESULT_BACKEND,
@@ -32,13 +65,33 @@ app.conf.timezone = 'UTC'
 RENEW_TIMEOUT = 60 * 30
 INITIAL_WEEKS_DEPTH = 10
 WEEKS_DEPTH = 2
-# NOTIFY_DELAY = 4
+WEEKS_CONCURRENCY = int(os.environ.get('WEEKS_CONCURRENCY', 4))
+CATALOG_CONCURRENCY = int(os.environ.get('CATALOG_CONCURRENCY', 4))
+# First sync of new subscription is interactive, so it uses more parallel requests
+INITIAL_WEEKS_CONCURRENCY = int(os.environ.get('INITIAL_WEEKS_CONCURRENCY', 12))
+NOTIFY_TICK = 60.0
+NOTIFY_BATCH = 500
+NOTIFY_CONCURRENCY = 8
+PLAN_REMINDERS_DELAY = 60.0 * 10
 UNLINK_DELAY = 60.0*20
+# Unsubscribed group is kept for a while, user may return to it
+UNUSED_GRACE = timedelta(days=1)
+UNLINK_BATCH = 500
+SCHEDULE_TICK = 60.0
+SCHEDULE_BATCH = 200
+FANOUT_BATCH = int(os.environ.get('FANOUT_BATCH', 25))
+FANOUT_INFLIGHT = int(os.environ.get('FANOUT_INFLIGHT', 4))
+FANOUT_TTL = 60 * 60 * 24
+FANOUT_RETRIES = 5
+FANOUT_RETRY_DELAY = 30
 
 @app.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
-    sender.add_periodic_task(RENEW_TIMEOUT*2, get_all_subscibtions_data.s(), name='Collect all subscriptions data every hour')
+    sender.add_periodic_task(SCHEDULE_TICK, schedule_subscriptions.s(), name='Refresh due subscriptions')
+    sender.add_periodic_task(RENEW_TIMEOUT*2, sync_refresh_schedule.s(), name='Sync subscriptions refresh schedule')
     sender.add_periodic_task(UNLINK_DELAY, unlink_non_used_subs.s(), name='Remove unused subscriptions')
+    sender.add_periodic_task(PLAN_REMINDERS_DELAY, plan_reminders.s(), name='Plan reminders')
+    sender.add_periodic_task(NOTIFY_TICK, notify_users.s(), name='Send due reminders')
     # sender.add_periodic_task(30.0, test.s('world'), expires=10)
     # Executes every hour
     sender.add_periodic_task(
@@ -46,100 +99,235 @@ def setup_periodic_tasks(sender, **kwargs):
         get_groups_schema.s(),
     )
 
-
-def merge_dictionaries(dict1, dict2):
-    merged_dictionary = {}
-
-    for key in dict1:
-        if key in dict2:
-            new_value = dict1[key] + dict2[key]
-        else:
-            new_value = dict1[key]
-
-        merged_dictionary[key] = new_value
-
-    for key in dict2:
-        if key not in merged_dictionary:
-            merged_dictionary[key] = dict2[key]
-
-    return merged_dictionary
+@worker_init.connect
+def bootstrap_indexes(**kwargs):
+    conn = MongoClient(MONGO_CONNECTION)
+    try:
+        db = conn.get_database(MONGO_DB)
+        users = Userdata(db)
+        if not users.has_subscribers_counters():
+            print('Subscribers counted: {0}'.format(users.recount_subscribers()))
+        migrated = Studiesdata(db).migrate_lessons()
+        if migrated:
+            print('Lessons migrated to current storage format: {0}'.format(migrated))
+        ensure_indexes(db)
+    finally:
+        conn.close()
+
+@worker_init.connect
+def serve_metrics(**kwargs):
+    reset_metrics_dir()
+    start_metrics_server()
+
+@worker_process_init.connect
+def reset_mongo_clients(**kwargs):
+    reset_clients()
+
+@worker_process_shutdown.connect
+def remove_process_metrics(pid=None, **kwargs):
+    process_dead(pid or os.getpid())
+
+_tasks_started = {}
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    _tasks_started[task_id] = time.perf_counter()
+
+@task_postrun.connect
+def observe_task_time(task_id=None, task=None, state=None, **kwargs):
+    started = _tasks_started.pop(task_id, None)
+    if started is not None:
+        observe_task(task.name, state, time.perf_counter() - started)
 
 
 @app.task(name='deferred.get_groups_schema')
 def get_groups_schema():
-    with StudiesStandalone(purge_schema=['faculties', 'groups']) as s:
+    faculties_data = collect_faculties()
+    if not faculties_data:
+        return {'faculties': 0, 'groups': 0}
 
-        faculties_data = collect_faculties()
-        s.update_faculties(faculties_data)
+    with ThreadPoolExecutor(max_workers=CATALOG_CONCURRENCY) as pool:
+        groups_data = pool.map(lambda facult: collect_groups(facult['id']), faculties_data)
+        faculties_groups = {facult['id']: groups for facult, groups in zip(faculties_data, groups_data)}
 
-        groups_total = 0
-        for facult in faculties_data:
-            groups_data = collect_groups(facult['id'])
-            if groups_data:
-                for gr in groups_data:
-                    groups_total += 1
-                    gr.update({'facultie': facult['id']})
-                s.update_groups(groups_data)
-        return {'faculties': len(faculties_data), 'groups': groups_total}
-
-
-def collect_lessons_data(facult, id_, params=None):
-    current_rasp = collect_rasp(facult, id_, params=params)
-    if current_rasp == None:
-        return
-    for rasp in current_rasp:
-        if rasp == []:
-            continue
-        weekday = datetime.strptime(rasp['date'], '%Y-%m-%d')
-        for lesson in rasp['lessons']:
-            lesson['time_start'] = convert_concat_day_and_lesson(lesson['time_start'], weekday)
-            lesson['time_end'] = convert_concat_day_and_lesson(lesson['time_end'], weekday)
-            lesson['weekday'] = rasp['weekday']
-    # use only lessons, without weeks info
-    lessons = []
-    for lesson in [rasp['lessons'] for rasp in current_rasp]:
-        lessons.extend(lesson)
-    return lessons
+    with StudiesStandalone() as s:
+        return s.replace_catalog(faculties_data, faculties_groups)
 
 
 @app.task
-def process_sub(sub, force=False, initial=False):
+def process_sub(sub, force=False, initial=False, due=False):
+    # force - full refresh: update timeout and stored states of weeks are ignored,
+    # due - subscription is refreshed by schedule, only update timeout isn't checked
     updates = {'timeout_passed':False}
     with StudiesStandalone() as s, \
             UserStandalone() as u:
-        if not force and not timeout_has_passed(sub, RENEW_TIMEOUT):
+        if not (force or due) and not timeout_has_passed(sub, RENEW_TIMEOUT):
             # print('Timeout isn\'t passed')
             return updates
         updates[sub['id']] = {}
         updates['timeout_passed'] = True
-        # [None] means current week
+        # Current week is included into weeks range
+        # New subscriber waits for the first sync, so it goes in interactive lane
         if initial:
-            weeks = [None] + strf_list(get_weeks_range(INITIAL_WEEKS_DEPTH))
+            weeks = get_weeks_range(INITIAL_WEEKS_DEPTH) + [datetime.now()]
+            concurrency, lane = INITIAL_WEEKS_CONCURRENCY, INTERACTIVE
         else:
-            weeks = [None] + strf_list(get_weeks_range(WEEKS_DEPTH))
-        for week in weeks:
-            lessons = collect_lessons_data(sub['facultie'], sub['id'], params={'date': week} if week != None else {})
-            if not lessons:
-                continue
-            upd = s.check_add_lessons(lessons, sub_id=str(sub['_id']))
-            updates[sub['id']] = merge_dictionaries(updates[sub['id']], upd)
+            weeks = get_weeks_range(WEEKS_DEPTH) + [datetime.now()]
+            concurrency, lane = WEEKS_CONCURRENCY, BULK
+        weeks = sorted({week_monday(week) for week in weeks})
+        with stage_timer('weeks_state'):
+            # Initial and forced syncs don't trust week states: lessons could be removed after states were saved,
+            # so neither fingerprints are compared, nor conditional requests are sent
+            states = {} if initial or force else s.get_weeks_state(sub['id'], weeks)
+
+        # All weeks are fetched concurrently, changed ones are reconciled as one batch
+        with stage_timer('fetch'):
+            pages = collect_weeks_pages(sub['facultie'], sub['id'], weeks, states, concurrency, lane)
+        updates[sub['id']], windows = sync_weeks(s, sub['id'], pages, states, sub_id=str(sub['_id']),
+                                                 timer=stage_timer)
+        for lessons in windows.values():
+            observe_week(lessons)
+        if windows:
+            observe_sync(updates[sub['id']])
+            publish_changes(u, sub, updates[sub['id']])
+        if any(page is not None for _, page in pages):
             u.update_subscription_acces_time(sub['_id'])
     return updates
 
 
+def publish_changes(u, sub, counters):
+    # Shared lectures change days of other groups of the stream, every group gets its own event,
+    # counters of the sync are published with the event of synced group only
+    changes = counters.pop('dates', {})
+    subs = u.get_subs_ids_by_group_ids(changes.keys()) if changes else {}
+    try:
+        for group_id, dates in changes.items():
+            if group_id not in subs:
+                continue
+            if group_id == sub['id']:
+                events.publish(subs[group_id], group_id, dates,
+                               counters.get('new', 0), counters.get('updated', 0), counters.get('deleted', 0))
+            else:
+                events.publish(subs[group_id], group_id, dates)
+    except RedisError as e:
+        # Lessons are already stored, readers fall back to cache expiration
+        print('Changes of {0} are not published: {1}'.format(sub['_id'], e))
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _fanout_key(run, name):
+    return 'fanout-{0}-{1}'.format(run, name)
+
+
+def process_subs(subs, force=False, due=False):
+    # Subscriptions of one batch share process-wide DB connections, only compact summary is returned
+    summary = {}
+    for sub in subs:
+        try:
+            updates = process_sub(sub, force=force, due=due)
+        except Exception as e:
+            print('Subscription {0} processing failed: {1}'.format(sub['_id'], e))
+            summary['failed'] = summary.get('failed', 0) + 1
+            continue
+        summary['processed'] = summary.get('processed', 0) + 1
+        for key, value in updates.get(sub['id'], {}).items():
+            summary[key] = summary.get(key, 0) + value
+    return summary
+
+
 @app.task(name='deferred.get_all_subscibtions_data')
 def get_all_subscibtions_data(force=False):
+    # Regular refreshes go by schedule, this is a manual refresh of every subscription ("refresh-all-subs"),
+    # e.g. after upstream or storage changes.
+    # Subscriptions ids are queued in batches, at most FANOUT_INFLIGHT batch tasks run at the same time,
+    # every finished batch task takes the next batch from queue
+    run = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    queue = _fanout_key(run, 'queue')
+    batches = 0
     with UserStandalone() as u:
-        res = group([process_sub.s(i, force=force) for i in u.get_all_subs(string_id=True)]).delay()
-    return res
+        for chunk in chunks((str(sub_id) for sub_id in u.get_all_subs_ids()), FANOUT_BATCH):
+            redis.rpush(queue, json.dumps(chunk))
+            batches += 1
+    redis.expire(queue, FANOUT_TTL)
+    redis.set('fanout-last', run, ex=FANOUT_TTL)
+    for _ in range(min(batches, FANOUT_INFLIGHT)):
+        process_subs_batch.delay(run, force=force)
+    return {'run': run, 'batches': batches}
+
+
+@app.task(name='deferred.process_subs_batch', bind=True, ignore_result=True, max_retries=FANOUT_RETRIES)
+def process_subs_batch(self, run, force=False):
+    try:
+        raw = redis.lpop(_fanout_key(run, 'queue'))
+    except RedisError as e:
+        # Nothing is taken yet, the same lane tries again later
+        raise self.retry(exc=e, countdown=FANOUT_RETRY_DELAY)
+    if raw is None:
+        return
+    try:
+        with UserStandalone() as u:
+            subs = list(u.get_subs_by_string_ids(json.loads(raw.decode('utf-8')), string_id=True))
+        summary = process_subs(subs, force=force)
+
+        summary_key = _fanout_key(run, 'summary')
+        pipe = redis.pipeline()
+        for key, value in summary.items():
+            pipe.hincrby(summary_key, key, value)
+        pipe.hincrby(summary_key, 'batches', 1)
+        pipe.expire(summary_key, FANOUT_TTL)
+        pipe.execute()
+    finally:
+        # Lane goes on even if this batch has failed, otherwise the rest of queue waits for its expiration
+        process_subs_batch.delay(run, force=force)
+
 
 @app.task(name='deferred.get_subscribtion')
 def get_subscribtion(sub_id, initial=False):
     with UserStandalone() as u:
         res = process_sub.delay(u.get_sub_by_string_id(sub_id=sub_id, string_id=True),  initial=initial)
+    schedule.add([sub_id])
     return res
 
 
+@app.task(name='deferred.schedule_subscriptions')
+def schedule_subscriptions():
+    due = schedule.pop_due(SCHEDULE_BATCH)
+    for chunk in chunks(due, FANOUT_BATCH):
+        refresh_subscriptions.delay(chunk)
+    return len(due)
+
+
+@app.task(name='deferred.refresh_subscriptions', ignore_result=True)
+def refresh_subscriptions(sub_ids):
+    with UserStandalone() as u:
+        subs = list(u.get_subs_by_string_ids(sub_ids, string_id=True))
+    schedule.remove(set(sub_ids) - {sub['_id'] for sub in subs})
+    for sub in subs:
+        summary = process_subs([sub], due=True)
+        if summary.get('new') or summary.get('updated') or summary.get('deleted') or summary.get('unlinked'):
+            schedule.mark_changed(sub['_id'])
+        schedule.schedule(sub['_id'])
+
+
+@app.task(name='deferred.sync_refresh_schedule')
+def sync_refresh_schedule():
+    with UserStandalone() as u:
+        existed = {str(sub_id) for sub_id in u.get_all_subs_ids()}
+    scheduled = set(schedule.scheduled())
+    schedule.remove(scheduled - existed)
+    return {'added': schedule.add(existed - scheduled), 'removed': len(scheduled - existed)}
+
+
 @app.task(name='deferred.get_user_subscribtion')
 def get_user_subscribtion(tel_user):
     with UserStandalone() as u:
@@ -148,23 +336,45 @@ def get_user_subscribtion(tel_user):
         return res
 
 
+def cached_teacher_data(kind, arg, collect):
+    hit, result = teachers.lookup(kind, arg)
+    try:
+        if not hit:
+            result = collect()
+            # None means that upstream is unavailable, such result isn't cached
+            if result is not None:
+                teachers.store(kind, arg, result)
+    finally:
+        # Waiting dialogs are answered even if collecting has failed
+        teachers.publish(kind, arg, result)
+        teachers.release(kind, arg)
+    return result
+
+
 @app.task(name='deferred.get_teacher_search')
 def get_teacher_search(name):
-    return get_teachers(name)
+    return cached_teacher_data(SEARCH, name, lambda: get_teachers(name))
 
 
 @app.task(name='deferred.get_teacher_lessons')
 def get_teacher_lessons(id_, params=None):
-    return get_teacher_rasp(id_, params=params)
+    if params:
+        return get_teacher_rasp(id_, params=params)
+    return cached_teacher_data(SCHEDULE, id_, lambda: get_teacher_rasp(id_))
 
 
 @app.task(name='deferred.unlink_non_used_subs')
 def unlink_non_used_subs():
+    lessons_rem = subs_rem = 0
     with StudiesStandalone() as s, \
             UserStandalone() as u:
-        unused = u.get_unused_subscriptions()
-        lessons_rem = s.remove_lessons_by_subscriptions([un['_id'] for un in unused])
-        subs_rem = u.delete_unused_subscriptions()
+        for unused in chunks(list(u.get_unused_subscriptions(UNUSED_GRACE)), UNLINK_BATCH):
+            groups = [sub['id'] for sub in u.get_subs_by_string_ids(unused)]
+            lessons_rem += s.remove_lessons_by_subscriptions(unused)
+            # Group may be subscribed again, its first sync must not skip weeks by states of removed lessons
+            s.remove_weeks_state(groups)
+            subs_rem += u.delete_unused_subscriptions(unused)
+            schedule.remove(unused)
     return {'lessons': lessons_rem, 'subscriptions': subs_rem}
 
 @app.task(name='deferred.purge_subscription_timeouts')
@@ -172,17 +382,50 @@ def purge_subscription_timeouts():
     with UserStandalone() as u:
         return u.purge_subscription_timeouts().raw_result
 
-@app.task(name='deferred.notify_users')
+@app.task(name='deferred.audit_query_plans')
+def audit_query_plans():
+    with StudiesStandalone() as s:
+        return audit_plans(s.db)
+
+@app.task(name='deferred.plan_reminders', ignore_result=True)
+def plan_reminders():
+    now = datetime.now()
+    with StudiesStandalone() as s, \
+            UserStandalone() as u:
+        lessons = list(s.get_lessons_starting(now, now + timedelta(seconds=reminders.horizon),
+                                              {'members.sub': 1, 'time_start': 1}))
+        chats = u.get_notify_chats({member['sub'] for lesson in lessons for member in lesson['members']})
+    planned = reminders.plan((chat_id, member['sub'], str(lesson['_id']), lesson['time_start'].timestamp())
+                             for lesson in lessons for member in lesson['members']
+                             for chat_id in chats.get(member['sub'], ()))
+    print('Reminders: {0}'.format(planned))
+    return planned
+
+@app.task(name='deferred.notify_users', ignore_result=True)
 def notify_users():
+    due = reminders.pop_due(NOTIFY_BATCH)
+    if not due:
+        return
+    now = datetime.now()
     with StudiesStandalone() as s, \
             UserStandalone() as u:
-        for user_sub_set in u.get_all_users_subscription_settings():
-            for sub, setting in user_sub_set.items():
-                if setting['notify']:
-                    print(s.get_lessons_by_subscription_in_range(sub, datetime.now(), datetime.now()+timedelta(days=3)))
-            # sub, settings = list(sub_set.items())
-            #
-            # print(sub)
-            # print(type(settings))
-            # if settings['notify']:
-            #     print(s.get_lessons_by_subscription_in_time(sub, datetime.now(), timedelta(days=10)))
+        # Notifications could be turned off after reminders were planned
+        chats = u.get_notify_chats({sub_id for _, sub_id, _ in due})
+        lessons = {str(lesson['_id']): lesson for lesson in s.get_lessons_by_ids({lesson_id for _, _, lesson_id in due})}
+    batches = collections.defaultdict(dict)
+    for chat_id, sub_id, lesson_id in due:
+        lesson = lessons.get(lesson_id)
+        if lesson and chat_id in chats.get(sub_id, ()) and lesson['time_start'] > now:
+            # Shared lecture of several subscribed groups is sent once
+            batches[chat_id][lesson_id] = lesson
+
+    def send(batch):
+        chat_id, chat_lessons = batch
+        return send_message(chat_id, format_reminder(sorted(chat_lessons.values(),
+                                                            key=lambda lesson: lesson['time_start']), now))
+
+    with ThreadPoolExecutor(max_workers=NOTIFY_CONCURRENCY) as pool:
+        sent = sum(pool.map(send, batches.items()))
+    print('Reminders sent: {0} of {1} chats'.format(sent, len(batches)))
+    if len(due) == NOTIFY_BATCH:
+        notify_users.delay()
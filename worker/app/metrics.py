@@ -0,0 +1,79 @@
+import os
+import glob
+import time
+
+# Prefork worker processes write metrics to files in this directory, main process serves them all.
+# Variable must be set before prometheus_client is imported
+MULTIPROC_DIR = os.environ.setdefault('prometheus_multiproc_dir', '/tmp/raspisator-metrics')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, start_http_server, multiprocess
+
+FETCH_SECONDS = Histogram('ruz_fetch_seconds', 'Latency of requests to ruz.spbstu.ru', ['lane', 'status'],
+                          buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10))
+FETCH_RETRIES = Counter('ruz_fetch_retries_total', 'Retried requests to ruz.spbstu.ru', ['lane', 'reason'])
+PARSE_SECONDS = Histogram('ruz_parse_seconds', 'Time to extract page state', ['method'],
+                          buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+WEEK_LESSONS = Histogram('ruz_week_lessons', 'Lessons on a fetched week page',
+                         buckets=(0, 5, 10, 20, 30, 40, 60, 100))
+LESSONS = Counter('lessons_synced_total', 'Synced lessons by result', ['result'])
+STAGE_SECONDS = Histogram('subscription_stage_seconds', 'Time of subscription refresh stages', ['stage'],
+                          buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+TASK_SECONDS = Histogram('celery_task_seconds', 'Duration of celery tasks', ['task', 'state'],
+                         buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900))
+
+
+class FetchMetrics:
+    # Observer, installed into collection with set_metrics: collection itself doesn't depend on prometheus_client
+    def fetched(self, lane, status, seconds):
+        FETCH_SECONDS.labels(lane, str(status)).observe(seconds)
+
+    def retried(self, lane, reason):
+        FETCH_RETRIES.labels(lane, reason).inc()
+
+    def parsed(self, method, seconds):
+        PARSE_SECONDS.labels(method).observe(seconds)
+
+
+class stage_timer:
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        STAGE_SECONDS.labels(self.stage).observe(time.perf_counter() - self.start)
+
+
+def observe_sync(counters):
+    for result in ('new', 'same', 'updated', 'deleted', 'unlinked'):
+        if counters.get(result):
+            LESSONS.labels(result).inc(counters[result])
+
+
+def observe_week(lessons):
+    WEEK_LESSONS.observe(len(lessons))
+
+
+def observe_task(task, state, seconds):
+    TASK_SECONDS.labels(task, state or 'UNKNOWN').observe(seconds)
+
+
+def reset_metrics_dir():
+    # Files of previous run would be summed with the new ones
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+    for path in glob.glob(os.path.join(MULTIPROC_DIR, '*.db')):
+        os.remove(path)
+
+
+def start_metrics_server(port=METRICS_PORT):
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(port, registry=registry)
+    print('Metrics are served on port {0}'.format(port))
+
+
+def process_dead(pid):
+    multiprocess.mark_process_dead(pid)
@@ -0,0 +1,52 @@
+import time
+
+from redis.exceptions import RedisError
+
+from .collection import INTERACTIVE, BULK
+
+# Token bucket, shared by all worker processes. Redis time is used, so hosts clocks don't matter.
+# ARGV[3] - amount of tokens, which lane can't take: bulk lane leaves the reserve to interactive one.
+# Returns 0 when token is taken, or milliseconds to wait for it
+_TAKE_TOKEN = """
+redis.replicate_commands()
+local rate, burst, floor = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens')) or burst
+local updated = tonumber(redis.call('HGET', KEYS[1], 'updated')) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 + floor then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 + floor - tokens) / rate * 1000)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return wait
+"""
+
+
+class TokenBucket:
+    def __init__(self, redis, key='ruz-rate-limit', rate=5.0, burst=10, interactive_reserve=3):
+        self.r = redis
+        self.key = key
+        self.rate = float(rate)
+        self.burst = max(int(burst), 1)
+        self.reserves = {INTERACTIVE: 0, BULK: min(interactive_reserve, self.burst - 1)}
+        self._take = redis.register_script(_TAKE_TOKEN)
+
+    def acquire(self, lane=BULK, timeout=60):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                wait = self._take(keys=[self.key], args=[self.rate, self.burst, self.reserves.get(lane, 0)])
+            except RedisError as e:
+                # Limiter is an optimization, requests shouldn't stop when redis is unreachable
+                print('Rate limiter is unavailable: {0}'.format(e))
+                return True
+            if wait == 0:
+                return True
+            if time.time() + wait / 1000.0 > deadline:
+                return False
+            time.sleep(wait / 1000.0)
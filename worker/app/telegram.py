@@ -0,0 +1,59 @@
+import os
+import time
+import requests
+
+BOT_TOKEN = os.environ.get('BOT_TOKEN', None)
+API_URL = 'https://api.telegram.org/bot{0}/{1}'
+TIMEOUT = 10
+RETRIES = 3
+
+_session = None
+_session_pid = None
+
+
+def get_session():
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session, _session_pid = requests.Session(), os.getpid()
+    return _session
+
+
+def send_message(chat_id, text, token=BOT_TOKEN):
+    # Bot itself isn't running in worker, so messages are sent directly with Bot API
+    if not token:
+        print('BOT_TOKEN is not set, message to {0} is not sent'.format(chat_id))
+        return False
+    for attempt in range(RETRIES):
+        try:
+            response = get_session().post(API_URL.format(token, 'sendMessage'), timeout=TIMEOUT,
+                                          json={'chat_id': chat_id, 'text': text,
+                                                'disable_web_page_preview': True})
+        except requests.RequestException as e:
+            print('Message to {0} failed: {1}'.format(chat_id, e))
+            continue
+        if response.ok:
+            return True
+        if response.status_code == 429:
+            # Flood limit, Telegram tells how long to wait
+            time.sleep(response.json().get('parameters', {}).get('retry_after', 1))
+            continue
+        # Chat is blocked or removed, retry won't help
+        print('Message to {0} rejected: {1} {2}'.format(chat_id, response.status_code, response.text))
+        return False
+    return False
+
+
+def format_reminder(lessons, now):
+    lines = []
+    for lesson in lessons:
+        minutes = max(0, int((lesson['time_start'] - now).total_seconds() // 60))
+        lines.append('⏰ Через {0} мин. {1}-{2}'.format(minutes, lesson['time_start'].strftime('%H:%M'),
+                                                           lesson['time_end'].strftime('%H:%M')))
+        lines.append('✏ {0}'.format(lesson['subject']))
+        if lesson.get('typeObj'):
+            lines.append('\U0001f50e {0}'.format(lesson['typeObj']['name']))
+        if lesson.get('auditories'):
+            auditory = lesson['auditories'][0]
+            lines.append('\U0001f3eb {0}, {1}'.format(auditory['building']['abbr'], auditory['name']))
+        lines.append('')
+    return '\n'.join(lines).strip()